@@ -4,15 +4,35 @@
 #include <pcre2.h>
 #include <stdbool.h>
 #include <stdio.h>
+#include <stdlib.h>
 #include <string.h>
 
-static struct linked_list * search(
-        const struct strlist *taglist, const char *lang, const char *order,
+struct tag {
+        const char *name;
+        uint32_t len;
+        char kind;
+};
+
+/* The unique tags found, deduplicated with an open addressing hash table of
+ * indices into `tags' (0 marks an empty slot). */
+struct tagset {
+        struct tag *tags;
+        uint32_t num;
+        uint32_t *table;
+        uint32_t mask;
+};
+
+static struct tagset * search(
+        const struct taglist *taglist, const char *lang, const char *order,
         const char *const *ctov, const char *const *skip
 );
 static void get_colon_delim_data(char **data, char *arg);
-static void print_data(const struct linked_list *ll, const char *vim_buf);
-static bool skip_tag(const char *const *skip, const char *find);
+static void print_data(const struct tagset *set, const char *vim_buf,
+                       size_t buflen);
+static bool add_tag(struct tagset *set, const struct tag *tag);
+static bool buf_contains(const char *buf, size_t buflen,
+                         const char *find, size_t len);
+static bool skip_tag(const char *const *skip, const char *find, size_t len);
 static bool is_correct_lang(const char *const *ctov, const char *lang,
                             const char *match_lang);
 static void normalize_lang(char *buf, const char *lang, const size_t max);
@@ -53,20 +73,23 @@ main(int argc, char **argv)
 
         get_colon_delim_data(skip, *argv++);
         get_colon_delim_data(ctov, *argv++);
-        struct strlist *taglist = get_all_lines(tagfile);
-        long i;
+        struct taglist *taglist = get_all_lines(tagfile);
+        size_t buflen = 0, nread;
 
         /* Slurp the whole vim_buf from the python code */
-        for (i = 0; i < nchars;)
-                vim_buf[i++] = (char)getchar();
-        vim_buf[i] = '\0';
+        while (buflen < (size_t)nchars &&
+               (nread = fread(vim_buf + buflen, 1, nchars - buflen, stdin)) > 0)
+                buflen += nread;
+        vim_buf[buflen] = '\0';
 
-        struct linked_list *ll = search(taglist, lang, order, CCC(ctov), CCC(skip));
-        print_data(ll, vim_buf);
+        struct tagset *set = search(taglist, lang, order, CCC(ctov), CCC(skip));
+        print_data(set, vim_buf, buflen);
 
         /* pointlessly free everything */
-        destroy_list(ll);
-        destroy_strlist(taglist);
+        free(set->tags);
+        free(set->table);
+        free(set);
+        destroy_taglist(taglist);
         char *buf, **tmp = skip;
         while ((buf = *tmp++) != NULL)
                 free(buf);
@@ -81,21 +104,31 @@ main(int argc, char **argv)
 }
 
 
-static struct linked_list *
-search(const struct strlist *taglist,
+static struct tagset *
+search(const struct taglist *taglist,
        const char *lang,
        const char *order,
        const char *const *ctov,
        const char *const *skip)
 {
-        struct linked_list *ll = new_list();
+        struct tagset *set = xmalloc(sizeof *set);
+        uint32_t size = 2;
+
+        /* Every line could be a tag, so both the tags and the hash table can
+         * be allocated once up front. */
+        while (size < taglist->num * 2)
+                size <<= 1;
+        set->tags  = xmalloc(sizeof *set->tags * (taglist->num + 1));
+        set->table = xcalloc(size, sizeof *set->table);
+        set->mask  = size - 1;
+        set->num   = 0;
 
         char pat[PATSIZ], match_lang[PATSIZ];
         pcre2_match_data *match_data;
         PCRE2_SIZE erroroffset;
         int errornumber;
         char norm_lang[PATSIZ / 2];
-        normalize_lang(norm_lang, lang, PATSIZ);
+        normalize_lang(norm_lang, lang, PATSIZ / 2);
 
         snprintf(pat, PATSIZ, "%s%s%s", PATTERN_PT1, norm_lang, PATTERN_PT2);
         PCRE2_SPTR pattern = (PCRE2_SPTR)pat;
@@ -111,16 +144,17 @@ search(const struct strlist *taglist,
                      (int)erroroffset, vim_buf);
         }
 
+        match_data = pcre2_match_data_create_from_pattern(cre, NULL);
+
         for (uint32_t iter = 0; iter < taglist->num; ++iter) {
-                if (taglist->s[iter][0] == '!' || taglist->s[iter][0] == '\0')
+                if (taglist->slen[iter] == 0 || taglist->s[iter][0] == '!')
                         continue;
 
                 PCRE2_SPTR subject = (PCRE2_SPTR)taglist->s[iter];
-                size_t subject_len = (size_t)(taglist->slen[iter] - 1);
+                size_t subject_len = (size_t)taglist->slen[iter];
 
-                match_data = pcre2_match_data_create_from_pattern(cre, NULL);
-                int rcnt   = pcre2_match(cre, subject, subject_len, 0,
-                                         PCRE2_CASELESS, match_data, NULL);
+                int rcnt = pcre2_match(cre, subject, subject_len, 0, 0,
+                                       match_data, NULL);
 
                 if (rcnt >= 0) {  /* match found */
                         PCRE2_SIZE *ovector =
@@ -129,13 +163,20 @@ search(const struct strlist *taglist,
 #define substr(INDEX)    _substr(INDEX, subject, ovector)
 #define substrlen(INDEX) _substrlen(INDEX, ovector)
 
-                        int len    = substrlen(tNAME) + 2;
-                        char *data = xmalloc(len);
-                        data[0]    = substr(tKIND)[0];
-
-                        strlcpy(match_lang, substr(tLANG),
-                                substrlen(tLANG) + 1);
-                        strlcpy(data + 1, substr(tNAME), len - 1);
+                        /* The tag is just a slice of the file's buffer. */
+                        struct tag tag = {
+                                .name = substr(tNAME),
+                                .len  = (uint32_t)substrlen(tNAME),
+                                .kind = substr(tKIND)[0]
+                        };
+
+                        /* Not strlcpy: it would run strlen over the rest of
+                         * the file, since the slice is not terminated. */
+                        size_t lang_len = (size_t)substrlen(tLANG);
+                        if (lang_len >= PATSIZ)
+                                lang_len = PATSIZ - 1;
+                        memcpy(match_lang, substr(tLANG), lang_len);
+                        match_lang[lang_len] = '\0';
 
                         /*
                          * Prune tags. Include only those that are:
@@ -144,24 +185,45 @@ search(const struct strlist *taglist,
                          *       and C++, generally ctags filters languages),
                          *    3) are not included in the `skip' list, and
                          *    4) are not duplicates.
-                         * If invalid, just free and move on.
                          */
-                        if ( strchr(order, (int)data[0]) &&
+                        if ( strchr(order, (int)tag.kind) &&
                              is_correct_lang(ctov, lang, match_lang) &&
-                            !skip_tag(skip, data + 1) &&
-                            !ll_find_str(ll, data))
+                            !skip_tag(skip, tag.name, tag.len))
                         {
-                                ll_add(ll, data);
-                        } else {
-                                free(data);
+                                add_tag(set, &tag);
                         }
                 }
-
-                pcre2_match_data_free(match_data);
         }
 
+        pcre2_match_data_free(match_data);
         pcre2_code_free(cre);
-        return ll;
+        return set;
+}
+
+
+/* Add a tag to the set unless an identical one (same kind and name) is
+ * already in it. */
+static bool
+add_tag(struct tagset *set, const struct tag *tag)
+{
+        uint32_t hash = 2166136261U;  /* FNV-1a */
+        for (uint32_t i = 0; i < tag->len; ++i)
+                hash = (hash ^ (unsigned char)tag->name[i]) * 16777619U;
+        hash = (hash ^ (unsigned char)tag->kind) * 16777619U;
+
+        uint32_t slot, pos = hash & set->mask;
+
+        while ((slot = set->table[pos]) != 0) {
+                const struct tag *cur = &set->tags[slot - 1];
+                if (cur->kind == tag->kind && cur->len == tag->len &&
+                    memcmp(cur->name, tag->name, tag->len) == 0)
+                        return false;
+                pos = (pos + 1) & set->mask;
+        }
+
+        set->tags[set->num] = *tag;
+        set->table[pos]     = ++set->num;
+        return true;
 }
 
 
@@ -187,27 +249,44 @@ get_colon_delim_data(char **data, char *arg)
 
 
 static void
-print_data(const struct linked_list *ll, const char *vim_buf)
+print_data(const struct tagset *set, const char *vim_buf, size_t buflen)
 {
-        struct Node *current = ll->head;
-
         /* Check whether the tag is present in the current nvim vim_buf */
-        while (current != NULL) {
-                if (strstr(vim_buf, current->data + 1) != NULL)
-                        printf("%c\n%s\n", current->data[0], current->data + 1);
-
-                current = current->next;
+        for (uint32_t i = 0; i < set->num; ++i) {
+                const struct tag *tag = &set->tags[i];
+                if (buf_contains(vim_buf, buflen, tag->name, tag->len))
+                        printf("%c\n%.*s\n", tag->kind, (int)tag->len,
+                               tag->name);
         }
 }
 
 
 static bool
-skip_tag(const char *const *skip, const char *find)
+buf_contains(const char *buf, size_t buflen, const char *find, size_t len)
+{
+        /* strstr is far faster than anything simple done by hand, but the
+         * tag names are not terminated, so copy them out first. */
+        char tmp[PATSIZ];
+        char *needle = (len < PATSIZ) ? tmp : xmalloc(len + 1);
+        bool ret;
+
+        memcpy(needle, find, len);
+        needle[len] = '\0';
+        ret = (buflen >= len && strstr(buf, needle) != NULL);
+
+        if (needle != tmp)
+                free(needle);
+        return ret;
+}
+
+
+static bool
+skip_tag(const char *const *skip, const char *find, size_t len)
 {
         const char *buf;
 
         while ((buf = *skip++) != NULL)
-                if (streq(buf, find))
+                if (strlen(buf) == len && memcmp(buf, find, len) == 0)
                         return true;
 
         return false;
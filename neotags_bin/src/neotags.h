@@ -25,32 +25,20 @@
 #include <stdint.h>
 #include <stdio.h>
 
-#define LLTYPE char *
-
-struct strlist {
-        char **s;
+/*
+ * A whole tags file held in one buffer (either mmap()ed or, for gzipped
+ * files, decompressed into a single allocation), plus an index of where each
+ * line starts. Lines are not NUL terminated; use `slen'.
+ */
+struct taglist {
+        char *buf;
+        size_t size;
+        bool mapped;
+        const char **s;
         uint32_t *slen;
         uint32_t num;
 };
 
-struct linked_list {
-        struct Node *head;
-        struct Node *tail;
-        uint32_t size;
-};
-
-struct Node {
-        LLTYPE data;
-        struct Node *prev;
-        struct Node *next;
-};
-
-enum ll_pop_type {
-        DEL_ONLY,
-        RET_ONLY,
-        BOTH
-};
-
 char *program_name;
 
 /*===========================================================================*/
@@ -107,30 +95,14 @@ char *program_name;
 
 long   __xatoi         (char *str, bool strict);
 int    my_fgetline     (char **ptr, FILE *fp);
-void   destroy_strlist (struct strlist *lst);
+void   destroy_taglist (struct taglist *lst);
 void * xmalloc         (const size_t size)                __attribute__((malloc));
 void * xcalloc         (const int num, const size_t size) __attribute__((malloc));
 void * xrealloc        (void *ptr, const size_t size)     __attribute__((malloc));
 FILE * safe_fopen      (const char * const restrict filename, const char * const restrict mode);
 void   dump_list       (char **list, FILE *fp);
 
-struct strlist * get_all_lines(const char *filename);
-
-
-/* linked_list.c */
-#define ll_pop(LIST)        _ll_popat((LIST), -1, BOTH)
-#define ll_dequeue(LIST)    _ll_popat((LIST), 0, BOTH)
-#define ll_pop_at(LIST,IND) _ll_popat((LIST), (IND), BOTH)
-#define ll_get(LIST,IND)    _ll_popat((LIST), (IND), RET_ONLY)
-#define ll_remove(LIST,IND) _ll_popat((LIST), (IND), DEL_ONLY)
-
-struct linked_list * new_list(void);
-
-void   ll_add(struct linked_list *list, LLTYPE data);
-void   ll_append(struct linked_list *list, LLTYPE data);
-LLTYPE _ll_popat(struct linked_list *list, long index, enum ll_pop_type type);
-bool   ll_find_str(struct linked_list *list, char *str);
-void   destroy_list(struct linked_list *list);
+struct taglist * get_all_lines(const char *filename);
 
 
 #ifdef __cplusplus
@@ -7,10 +7,16 @@
 #include <inttypes.h>
 #include <zlib.h>
 
-#define STARTSIZE 2048
-#define INCSIZE   256
-#define GUESS 100
-#define INC   10
+#if defined(_WIN32) && !defined(__CYGWIN__)
+#  define USE_MMAP 0
+#else
+#  define USE_MMAP 1
+#  include <fcntl.h>
+#  include <sys/mman.h>
+#endif
+
+#define GZBUFSIZ (128 * 1024)
+#define MAXREAD  (1U << 30)
 
 #define safe_stat(PATH, ST)                                         \
      do {                                                           \
@@ -18,77 +24,190 @@
                      xperror("Failed to stat file '%s", (PATH));    \
      } while (0)
 
-static bool file_is_reg(const char *filename);
-static void safe_gzopen(gzFile *fp, const char *filename, const char *mode);
-static int my_gfgetline(char **ptr, gzFile *fp);
+static bool   file_is_reg(const char *filename);
+static bool   is_gzipped(const char *filename);
+static size_t gzip_size_hint(const char *filename);
+static void   safe_gzopen(gzFile *fp, const char *filename, const char *mode);
+static void   read_gzip(struct taglist *lst, const char *filename);
+static void   map_file(struct taglist *lst, const char *filename);
+static void   index_lines(struct taglist *lst);
+
+
+/*
+ * Load a whole tags file with a constant number of allocations: the file is
+ * either mapped or decompressed into one buffer, and the line index is sized
+ * exactly by counting the lines first.
+ */
+struct taglist *
+get_all_lines(const char *filename)
+{
+        struct taglist *lst = xmalloc(sizeof *lst);
 
+        if (!file_is_reg(filename))
+                xerr(1, "Invalid filetype '%s'\n", filename);
 
-static int
-my_gfgetline(char **ptr, gzFile *fp)
-{
-        int ch, it, size;
-        char *buf, *temp;
-
-        buf = temp = NULL;
-        buf  = xmalloc(STARTSIZE);
-        size = STARTSIZE;
-
-        it = 0;
-        while ((ch = gzgetc(*fp)) != '\n' && ch != EOF) {
-                if (ch == '\r')
-                        continue;
-                if (it >= (size - 1)) {
-                        size += INCSIZE;
-                        temp = xrealloc((void*)buf, size);
-                        buf = temp;
-                }
+        if (is_gzipped(filename))
+                read_gzip(lst, filename);
+        else
+                map_file(lst, filename);
+
+        index_lines(lst);
+        return lst;
+}
 
-                buf[it++] = ch;
-        }
 
-        if (ch == EOF && it == 0) {
-                free(buf);
-                *ptr = NULL;
-                return 0;
+static void
+index_lines(struct taglist *lst)
+{
+        const char *ptr = lst->buf;
+        const char *end = lst->buf + lst->size;
+        const char *eol;
+        uint32_t num = 0;
+
+        for (; ptr < end; ptr = eol + 1) {
+                ++num;
+                if ((eol = memchr(ptr, '\n', end - ptr)) == NULL)
+                        break;
         }
 
-        buf[it++] = '\0';
+        lst->s    = xmalloc(sizeof *lst->s * (num + 1));
+        lst->slen = xmalloc(sizeof *lst->slen * (num + 1));
+        lst->num  = 0;
+
+        for (ptr = lst->buf; ptr < end; ptr = eol + 1) {
+                eol = memchr(ptr, '\n', end - ptr);
+                size_t len = (size_t)((eol ? eol : end) - ptr);
+                if (len > 0 && ptr[len - 1] == '\r')
+                        --len;
 
-        temp = xrealloc(buf, it);
-        *ptr = temp;
+                lst->s[lst->num]      = ptr;
+                lst->slen[lst->num++] = (uint32_t)len;
 
-        return it;
+                if (eol == NULL)
+                        break;
+        }
 }
 
 
-struct strlist *
-get_all_lines(const char *filename)
+static void
+read_gzip(struct taglist *lst, const char *filename)
 {
         gzFile fp;
-        safe_gzopen(&fp, filename, "rb");
-        struct strlist *lst = xmalloc(sizeof *lst);
-        uint32_t max = GUESS;
+        size_t len = 0;
+        size_t cap = gzip_size_hint(filename) + 1;
+        char *buf  = xmalloc(cap);
 
-        lst->s    = xmalloc(sizeof *lst->s * max);
-        lst->slen = xmalloc(sizeof *lst->slen * max);
-        lst->num  = 0;
-
-        do {
-                if (lst->num == max) {
-                        max += INC;
-                        lst->slen = xrealloc(lst->slen, sizeof *lst->slen * max);
-                        lst->s    = xrealloc(lst->s, sizeof *lst->s * max);
+        safe_gzopen(&fp, filename, "rb");
+        gzbuffer(fp, GZBUFSIZ);
+
+        /* With a correct size hint the buffer is never grown. The extra byte
+         * lets the read that hits EOF happen without a reallocation. */
+        for (;;) {
+                if (len == cap) {
+                        cap *= 2;
+                        buf = xrealloc(buf, cap);
                 }
-                lst->slen[lst->num] = my_gfgetline((lst->s + lst->num), &fp);
 
-        } while (lst->slen[lst->num++] > 0);
+                size_t want = cap - len;
+                if (want > MAXREAD)
+                        want = MAXREAD;
 
-        lst->slen = xrealloc(lst->slen, sizeof *lst->slen * lst->num);
-        lst->s = xrealloc(lst->s, sizeof *lst->s * lst->num);
-        --lst->num;
+                int nread = gzread(fp, buf + len, (unsigned)want);
+                if (nread < 0)
+                        xerr(1, "Failed to decompress file '%s'\n", filename);
+                if (nread == 0)
+                        break;
+                len += (size_t)nread;
+        }
 
         gzclose(fp);
-        return lst;
+        lst->buf    = buf;
+        lst->size   = len;
+        lst->mapped = false;
+}
+
+
+static void
+map_file(struct taglist *lst, const char *filename)
+{
+        struct stat st;
+        safe_stat(filename, &st);
+
+        lst->size   = (size_t)st.st_size;
+        lst->mapped = false;
+        lst->buf    = NULL;
+
+        if (lst->size == 0)
+                return;
+
+#if USE_MMAP
+        int fd = open(filename, O_RDONLY);
+        if (fd == -1)
+                xperror("Failed to open file '%s'", filename);
+
+        void *map = mmap(NULL, lst->size, PROT_READ, MAP_PRIVATE, fd, 0);
+        close(fd);
+
+        if (map != MAP_FAILED) {
+                lst->buf    = map;
+                lst->mapped = true;
+                return;
+        }
+#endif
+        FILE *fp = fopen(filename, "rb");
+        if (fp == NULL)
+                xperror("Failed to open file '%s'", filename);
+
+        lst->buf = xmalloc(lst->size);
+        if (fread(lst->buf, 1, lst->size, fp) != lst->size)
+                xperror("Failed to read file '%s'", filename);
+        fclose(fp);
+}
+
+
+static bool
+is_gzipped(const char *filename)
+{
+        unsigned char magic[2] = {0, 0};
+        FILE *fp = fopen(filename, "rb");
+        if (fp == NULL)
+                xperror("Failed to open file '%s'", filename);
+
+        size_t nread = fread(magic, 1, 2, fp);
+        fclose(fp);
+
+        return nread == 2 && magic[0] == 0x1f && magic[1] == 0x8b;
+}
+
+
+/*
+ * The last four bytes of a gzip file hold the size of the uncompressed data
+ * (modulo 2^32) of its last member. That is exact for files we write
+ * ourselves; the compressed size is used as a floor for anything else.
+ */
+static size_t
+gzip_size_hint(const char *filename)
+{
+        struct stat st;
+        unsigned char tail[4];
+        size_t hint = 0;
+        FILE *fp;
+
+        safe_stat(filename, &st);
+        if ((fp = fopen(filename, "rb")) == NULL)
+                xperror("Failed to open file '%s'", filename);
+
+        if (st.st_size >= 18 && fseek(fp, -4L, SEEK_END) == 0 &&
+            fread(tail, 1, 4, fp) == 4)
+        {
+                hint = (size_t)tail[0]       | (size_t)tail[1] << 8 |
+                       (size_t)tail[2] << 16 | (size_t)tail[3] << 24;
+        }
+        fclose(fp);
+
+        if (hint < (size_t)st.st_size)
+                hint = (size_t)st.st_size;
+        return hint;
 }
 
 
@@ -100,8 +219,6 @@ safe_gzopen(gzFile *fp,
         *fp = gzopen(filename, mode);
         if (!*fp)
                 xperror("Failed to open file '%s'", filename);
-        if (!file_is_reg(filename))
-                xerr(1, "Invalid filetype '%s'\n", filename);
 }
 
 
@@ -115,10 +232,14 @@ file_is_reg(const char *filename)
 
 
 void
-destroy_strlist(struct strlist *lst)
+destroy_taglist(struct taglist *lst)
 {
-        for (uint32_t i = 0; i < lst->num; ++i)
-                free(lst->s[i]);
+#if USE_MMAP
+        if (lst->mapped)
+                munmap(lst->buf, lst->size);
+        else
+#endif
+                free(lst->buf);
         free(lst->s);
         free(lst->slen);
         free(lst);
@@ -45,6 +45,10 @@ if !exists('g:neotags_norecurse_dirs')
                 \ ]
 endif
 
+if !exists('g:neotags_library_dirs')
+    let g:neotags_library_dirs = []
+endif
+
 if !exists('g:neotags_ignored_tags')
     let g:neotags_ignored_tags = []
 endif
@@ -115,6 +119,58 @@ if !exists('g:neotags_silent_timeout')
     let g:neotags_silent_timeout = 0
 endif
 
+if !exists('g:neotags_ctags_batch')
+    let g:neotags_ctags_batch = 1000
+endif
+
+if !exists('g:neotags_ctags_stream')
+    let g:neotags_ctags_stream = 0
+endif
+
+if !exists('g:neotags_multiwindow')
+    let g:neotags_multiwindow = 0
+endif
+
+if !exists('g:neotags_binary_threshold')
+    let g:neotags_binary_threshold = 0
+endif
+
+if !exists('g:neotags_startup_prewarm')
+    let g:neotags_startup_prewarm = 0
+endif
+
+if !exists('g:neotags_sharded')
+    let g:neotags_sharded = 0
+endif
+
+if !exists('g:neotags_shard_by_dir')
+    let g:neotags_shard_by_dir = 0
+endif
+
+if !exists('g:neotags_highlight_budget')
+    let g:neotags_highlight_budget = 50
+endif
+
+if !exists('g:neotags_max_jobs')
+    let g:neotags_max_jobs = 1
+endif
+
+if !exists('g:neotags_idle_delay')
+    let g:neotags_idle_delay = 100
+endif
+
+if !exists('g:neotags_largefile_lines')
+    let g:neotags_largefile_lines = 20000
+endif
+
+if !exists('g:neotags_largefile_tags')
+    let g:neotags_largefile_tags = 20000
+endif
+
+if !exists('g:neotags_largefile_latency')
+    let g:neotags_largefile_latency = 500
+endif
+
 if !exists('g:neotags_patternlength')
     let g:neotags_patternlength = 2048
 endif
@@ -191,6 +247,7 @@ command! -nargs=1 NeotagsAddProject call NeotagsAddProject(<args>)
 command! -nargs=1 NeotagsRemoveProject call NeotagsRemoveProject(<args>)
 command! NeotagsBinaryToggle call Neotags_Toggle_C_Binary()
 command! NeotagsVerbosity call Neotags_Toggle_Verbosity()
+command! NeotagsStats call NeotagsStats()
 
 nnoremap <unique> <Plug>NeotagsToggle :call NeotagsToggle()<CR>
 nmap <silent> <leader>tag <Plug>NeotagsToggle
@@ -6,9 +6,15 @@
 # ============================================================================
 import neovim
 
+from neotags.jobs import BACKGROUND, HIGHLIGHT, REINDEX
 from neotags.neotags import Neotags
 
 
+def _buffer(args):
+    """The buffer number autocmds pass as expand('<abuf>'), if any."""
+    return int(args[0]) if args and args[0] else None
+
+
 @neovim.plugin
 class NeotagsHandlers(object):
 
@@ -18,36 +24,49 @@ class NeotagsHandlers(object):
 
     @neovim.function('NeotagsInit')
     def init(self, args):
-        self.__vim.async_call(self.__neotags.init)
+        self.__neotags.submit(HIGHLIGHT, 'init', self.__neotags.init)
 
     @neovim.function('NeotagsHighlight')
     def highlight(self, args):
-        self.__vim.async_call(self.__neotags.highlight, False)
+        self.__neotags.submit(HIGHLIGHT, ('highlight', _buffer(args)),
+                              self.__neotags.highlight, False)
 
     @neovim.function('NeotagsRehighlight')
     def rehighlight(self, args):
-        self.__vim.async_call(self.__neotags.highlight, True)
+        self.__neotags.submit(HIGHLIGHT, ('rehighlight', _buffer(args)),
+                              self.__neotags.highlight, True)
+
+    @neovim.function('NeotagsIdle')
+    def idle(self, args):
+        self.__neotags.submit(BACKGROUND, 'idle', self.__neotags.idle)
 
     @neovim.function('NeotagsUpdate')
     def update(self, args):
-        self.__vim.async_call(self.__neotags.update)
+        self.__neotags.submit(REINDEX, ('update', _buffer(args)),
+                              self.__neotags.update)
 
     @neovim.function('NeotagsToggle')
     def toggle(self, args):
-        self.__vim.async_call(self.__neotags.toggle)
+        self.__neotags.submit(HIGHLIGHT, None, self.__neotags.toggle)
 
     @neovim.function('NeotagsAddProject')
     def setbase(self, args):
-        self.__vim.async_call(self.__neotags.setBase, args)
+        self.__neotags.submit(REINDEX, None, self.__neotags.setBase, args)
 
     @neovim.function('NeotagsRemoveProject')
     def removebase(self, args):
-        self.__vim.async_call(self.__neotags.removeBase, args)
+        self.__neotags.submit(REINDEX, None, self.__neotags.removeBase,
+                              args)
 
     @neovim.function('Neotags_Toggle_C_Binary')
     def toggle_C_bin(self, args):
-        self.__vim.async_call(self.__neotags.toggle_C_bin)
+        self.__neotags.submit(HIGHLIGHT, None, self.__neotags.toggle_C_bin)
 
     @neovim.function('Neotags_Toggle_Verbosity')
     def toggle_verbosity(self, args):
-        self.__vim.async_call(self.__neotags.toggle_verbosity)
+        self.__neotags.submit(HIGHLIGHT, None,
+                              self.__neotags.toggle_verbosity)
+
+    @neovim.function('NeotagsStats')
+    def stats(self, args):
+        self.__neotags.submit(HIGHLIGHT, None, self.__neotags.stats)
@@ -0,0 +1,150 @@
+# ============================================================================
+# File:        jobs.py
+# Author:      Christian Persson <c0r73x@gmail.com>
+# Repository:  https://github.com/c0r73x/neotags.nvim
+#              Released under the MIT license
+# ============================================================================
+import heapq
+import threading
+import time
+
+# Evaluated in nvim to capture the state a job was started for.
+STATE_EXPR = "[bufnr('%'), b:changedtick, &ft]"
+
+# Scheduler priority classes, most urgent first.
+HIGHLIGHT = 0
+REINDEX = 1
+BACKGROUND = 2
+
+CLASS_NAMES = ('highlight', 'reindex', 'background')
+
+
+class JobCancelled(Exception):
+    """Raised inside a job once its token has been cancelled."""
+
+
+class CancelToken(object):
+    """Identifies the (buffer, changedtick, filetype) a highlight or parse job
+    was started for. Jobs check their token between phases and inside long
+    loops, and give up as soon as a newer request cancels it or the buffer it
+    was started for is no longer the current one."""
+
+    def __init__(self, buffer, changedtick, filetype):
+        self.buffer = buffer
+        self.changedtick = changedtick
+        self.filetype = filetype
+        self.cancelled = False
+        self.reason = None
+        self.polled = time.time()
+
+    def cancel(self, reason='superseded'):
+        if not self.cancelled:
+            self.cancelled = True
+            self.reason = reason
+
+    def check(self):
+        if self.cancelled:
+            raise JobCancelled(self.reason)
+
+    def verify(self, buffer, changedtick, filetype):
+        """Cancel the token if the given state differs from the one it was
+        created with, then check it."""
+        if buffer != self.buffer or filetype != self.filetype:
+            self.cancel('buffer changed')
+        elif changedtick != self.changedtick:
+            self.cancel('buffer modified')
+        self.check()
+
+
+class Scheduler(object):
+    """Runs plugin work on nvim's main loop in priority order.
+
+    Jobs are queued with a priority class and a key. A job submitted while
+    another with the same key is still waiting replaces it, keeping its
+    place in the queue (or the better place of the two), so that a burst of
+    identical requests runs once. At most limit jobs are in progress at a
+    time; as jobs run in their own greenlets, one can start while another
+    is waiting on nvim. submit() may be called from any thread."""
+
+    def __init__(self, vim, limit=1):
+        self.limit = limit
+        self.__vim = vim
+        self.__lock = threading.Lock()
+        self.__heap = []
+        self.__entries = {}
+        self.__seq = 0
+        self.__active = 0
+        self.__deduped = 0
+        self.__waits = [[0, 0.0, 0.0] for _ in CLASS_NAMES]
+
+    def submit(self, priority, key, func, *args):
+        """Queue func(*args). A key of None is never deduplicated."""
+        with self.__lock:
+            self.__seq += 1
+            if key is None:
+                key = ('job', self.__seq)
+
+            entry = self.__entries.get(key)
+            if entry is not None:
+                self.__deduped += 1
+                entry[2], entry[3] = func, args
+                if priority >= entry[0]:
+                    return
+                # Move it up; the old heap item is skipped once popped.
+                entry[0], entry[1] = priority, self.__seq
+            else:
+                entry = [priority, self.__seq, func, args, time.time()]
+                self.__entries[key] = entry
+            heapq.heappush(self.__heap, (priority, self.__seq, key))
+
+            dispatch = self.__active < self.limit
+            if dispatch:
+                self.__active += 1
+
+        if dispatch:
+            self.__vim.async_call(self._run_next)
+
+    def _pop(self):
+        while self.__heap:
+            priority, seq, key = heapq.heappop(self.__heap)
+            entry = self.__entries.get(key)
+            if entry is not None and entry[1] == seq:
+                del self.__entries[key]
+                return entry
+        return None
+
+    def _run_next(self):
+        with self.__lock:
+            entry = self._pop()
+            if entry is None:
+                self.__active -= 1
+                return
+
+            priority, _, func, args, queued = entry
+            waits = self.__waits[priority]
+            wait = time.time() - queued
+            waits[0] += 1
+            waits[1] += wait
+            waits[2] = max(waits[2], wait)
+
+        try:
+            func(*args)
+        finally:
+            # Keep the slot and look for more work on the next turn of the
+            # loop, after whatever nvim has sent in the meantime.
+            self.__vim.async_call(self._run_next)
+
+    def stats(self):
+        with self.__lock:
+            stats = {
+                'jobs.queued': len(self.__entries),
+                'jobs.active': self.__active,
+                'jobs.deduped': self.__deduped,
+            }
+            for name, (count, total, longest) in zip(CLASS_NAMES,
+                                                     self.__waits):
+                if count:
+                    stats['jobs.wait.%s' % name] = (
+                        '%d jobs, %.3fs avg, %.3fs max'
+                        % (count, total / count, longest))
+        return stats
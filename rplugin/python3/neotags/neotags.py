@@ -9,18 +9,105 @@
 # without the module (and therefore essentially without the kill function,
 # beggers can't be choosers). Psutil is not and will never be available on
 # cygwin, which makes this plugin unusable there without this change.
-import gzip
-import hashlib
+#
+# The same goes for gzip, subprocess and tempfile: they are only imported by
+# _load_modules() the first time real work is done, so that NeotagsInit can
+# return immediately when g:neotags_startup_prewarm is set.
 # import mmap
+import io
 import os
+import queue
 import re
-import subprocess
+import threading
 import time
+import weakref
+from collections import OrderedDict
 from sys import platform
+
+import greenlet
 from neovim.api.nvim import NvimError
-from tempfile import mkstemp
+
+from neotags import tagindex
+from neotags.jobs import (BACKGROUND, HIGHLIGHT, REINDEX, STATE_EXPR,
+                          CancelToken, JobCancelled, Scheduler)
+from neotags.taggroups import TagGroups
+
+gzip = subprocess = mkstemp = None
 
 SUFFIX = '.gz'
+PREWARM_NICENESS = 10
+PREWARM_PAUSE = 0.05
+CHECK_INTERVAL = 1024
+POLL_INTERVAL = 0.05
+STREAM_CHUNK = 65536
+STREAM_INTERVAL = 0.5
+FULL_GROUPS = 8
+
+
+def _load_modules():
+    """Import the heavier modules on first use. Returns the time taken."""
+    global gzip, subprocess, mkstemp
+    if mkstemp is not None:
+        return 0.0
+
+    start = time.time()
+    import gzip
+    import subprocess
+    from tempfile import mkstemp
+    return time.time() - start
+
+
+def _lower_priority():
+    os.nice(PREWARM_NICENESS)
+
+
+def _tree_signature(path):
+    """Summarise the state of a directory tree by the number of files in it
+    and the newest mtime of any file or directory."""
+    count = 0
+    newest = os.path.getmtime(path)
+
+    for root, dirs, files in os.walk(path):
+        dirs[:] = [d for d in dirs if not d.startswith('.')]
+        for name in dirs + files:
+            try:
+                newest = max(newest, os.path.getmtime(os.path.join(root, name)))
+            except OSError:
+                continue
+        count += len(files)
+
+    return '%d:%.6f' % (count, newest)
+
+
+def _read_signature(tagfile):
+    try:
+        with open(tagfile + '.sig', 'r') as fp:
+            return fp.read().strip()
+    except IOError:
+        return None
+
+
+def _write_signature(tagfile, signature):
+    with open(tagfile + '.sig', 'w') as fp:
+        fp.write(signature + '\n')
+
+
+def _read_pipe(pipe, chunks):
+    """Pass everything read from pipe on to the queue, ending with b''."""
+    while True:
+        data = pipe.read1(STREAM_CHUNK)
+        chunks.put(data)
+        if not data:
+            break
+
+
+def _split_cmds(cmds):
+    """Split the commands built by _highlight_cmds into one part per syntax
+    command. The first part also clears the old syntax and links the group,
+    so that each part can be sent on its own."""
+    parts = [[cmd] for cmd in cmds[1:-1]] or [[]]
+    parts[0] = cmds[:1] + parts[0] + cmds[-1:]
+    return parts
 
 
 class Neotags(object):
@@ -31,18 +118,33 @@ class Neotags(object):
         self.__suffix = '\>'
         self.__current_file = ''
         self.__initialized = False
-        self.__is_running = False
+        self.__job = None
+        self.__scheduler = Scheduler(vim)
 
         self.__groups = {}
+        self.__full_groups = OrderedDict()
+        self.__windows = {}
         self.__cmd_cache = {}
         self.__md5_cache = {}
         self.__tmp_cache = {}
+        self.__index_cache = {}
+        self.__stats = {}
+
+        self.__fresh = set()
+        self.__resumable = set()
+        self.__pending = {}
+        self.__latency = {}
+        self.__idle_scheduled = False
+        self.__prewarm = False
+        self.__prewarm_thread = None
+        self.__library_thread = None
 
         self.__ignore = []
         self.__ignored_tags = []
+        self.__library_dirs = []
         self.__notin = []
         self.__seen = []
-        self.__start_time = []
+        self.__start_time = weakref.WeakKeyDictionary()
         self.__backup = []
 
         self.__directory = None
@@ -50,8 +152,6 @@ class Neotags(object):
         self.__neotags_bin = None
         self.__noRecurseDirs = None
         self.__settingsFile = None
-        self.__slurp = None
-        self.__tagfile = None
 
         self.__globtime = time.time()
         self.__hlbuf = 1
@@ -62,6 +162,7 @@ class Neotags(object):
     def init(self):
         if (self.__initialized):
             return
+        init_start = time.time()
         self.__backup = [self._debug_echo, self._debug_start, self._debug_end]
 
         if (not self.__vim.vars['neotags_verbose']):
@@ -91,6 +192,25 @@ class Neotags(object):
         self.__settingsFile = self.__vim.vars['neotags_settings_file']
 
         self.__neotags_bin = self._get_binary()
+        self.__bin_threshold = self.__vim.vars['neotags_binary_threshold']
+        self.__sharded = self.__vim.vars['neotags_sharded']
+        self.__shard_by_dir = self.__vim.vars['neotags_shard_by_dir']
+        self.__stream = self.__vim.vars['neotags_ctags_stream']
+        self.__multiwindow = self.__vim.vars['neotags_multiwindow']
+        self.__scheduler.limit = max(self.__vim.vars['neotags_max_jobs'], 1)
+        self.__batch = self.__vim.vars['neotags_ctags_batch']
+        self.__library_dirs = [
+            os.path.realpath(os.path.expanduser(path))
+            for path in self.__vim.vars['neotags_library_dirs']
+        ]
+        self.__budget = self.__vim.vars['neotags_highlight_budget']
+        self.__idle_delay = self.__vim.vars['neotags_idle_delay']
+        self.__largefile = (
+            self.__vim.vars['neotags_largefile_lines'],
+            self.__vim.vars['neotags_largefile_tags'],
+            self.__vim.vars['neotags_largefile_latency'],
+        )
+        self.__prewarm = prewarm = self.__vim.vars['neotags_startup_prewarm']
 
         if (self.__vim.vars['neotags_enabled']):
             evupd = ','.join(self.__vim.vars['neotags_events_update'])
@@ -100,21 +220,39 @@ class Neotags(object):
             self.__patternlength = self.__vim.vars['neotags_patternlength']
 
             self.__vim.command(
-                'autocmd %s * call NeotagsUpdate()' % evupd,
+                'autocmd %s * call NeotagsUpdate(expand("<abuf>"))' % evupd,
                 async=True
             )
             self.__vim.command(
-                'autocmd %s * call NeotagsHighlight()' % evhl,
+                'autocmd %s * call NeotagsHighlight(expand("<abuf>"))' % evhl,
                 async=True
             )
             self.__vim.command(
-                'autocmd %s * call NeotagsRehighlight()' % evre,
+                'autocmd %s * call NeotagsRehighlight(expand("<abuf>"))'
+                % evre,
                 async=True
             )
 
-            if (self.__vim.vars['loaded_neotags']):
-                self.highlight(False)
+            if (self.__batch):
+                self.__vim.command(
+                    'autocmd CursorHold * call NeotagsIdle()',
+                    async=True
+                )
+                # Carry on with the checkpoints of an earlier session.
+                self.__resumable.update(
+                    tagindex.checkpointed(self.__directory))
+
+            if (self.__library_dirs):
+                self.submit(BACKGROUND, 'library', self._start_library)
 
+            if (prewarm):
+                self._start_prewarm(self.__vim.vars['loaded_neotags'])
+            else:
+                self.__stats['startup.imports'] = _load_modules()
+                if (self.__vim.vars['loaded_neotags']):
+                    self.highlight(False)
+
+        self.__stats['startup.init'] = time.time() - init_start
         self.__initialized = True
 
     def toggle(self):
@@ -153,8 +291,41 @@ class Neotags(object):
             self._debug_start = self._debug_echo = self._debug_end = self.__void
             self.__vim.vars['neotags_verbose'] = 0
 
-    def update(self, force=False):
+    def submit(self, priority, key, func, *args):
+        """Queue func(*args) on the scheduler (see jobs.Scheduler). A
+        highlight request for another buffer cancels the job in progress,
+        which gives up the next time it polls its token (see _poll)."""
+        job = self.__job
+        if (priority == HIGHLIGHT and job is not None
+                and isinstance(key, tuple) and key[1] is not None
+                and key[1] != job.buffer):
+            job.cancel()
+        self.__scheduler.submit(priority, key, func, *args)
+
+    def stats(self):
+        """Echo the timing statistics collected so far."""
+        if not self.__stats:
+            self._inform_echo('No statistics collected yet.')
+            return
+
+        stats = dict(self.__stats)
+        stats.update(self.__scheduler.stats())
+        for key in sorted(stats):
+            value = stats[key]
+            if isinstance(value, float):
+                value = '%.3fs' % value
+            self._inform_echo('%s: %s' % (key, value))
+
+    def update(self, force=False, buffer=None):
         """Update tags file, tags cache, and highlighting."""
+        _load_modules()
+        if buffer is not None and buffer != self.__vim.api.eval("bufnr('%')"):
+            # Requeued after the user moved on: leave the update to the next
+            # highlight of that buffer.
+            if buffer in self.__seen:
+                self.__seen.remove(buffer)
+            return
+
         ft = self.__vim.api.eval('&ft')
         if (not self.__vim.vars['neotags_enabled']):
             self._debug_echo('Update called when plugin disabled...', False)
@@ -164,17 +335,24 @@ class Neotags(object):
         if (ft == '' or ft in self.__ignore):
             return
 
-        if (self.__is_running):
-            return
-        self.__is_running = True
-
-        self._update(ft)
-
-        self.__is_running = False
+        token = self._start_job()
+        if not self._run_job(token, self._update, ft, token, True):
+            if token.reason == 'superseded':
+                # A newer job took over before the index was rebuilt. Run
+                # the update again after it rather than lose the write.
+                self.submit(REINDEX, ('update', token.buffer),
+                            self.update, force, token.buffer)
+                return
+            if token.reason != 'buffer modified':
+                return
+            # Edited mid-update: make the highlight below parse again.
+            if token.buffer in self.__seen:
+                self.__seen.remove(token.buffer)
         self.highlight(False)
 
-    def highlight(self, clear):
+    def highlight(self, clear, requeued=False):
         """Analyze the tags data and format it for nvim's regex engine."""
+        _load_modules()
         self.__globtime = time.time()
         self.__exists_buffer = {}
         ft = self.__vim.api.eval('&ft')
@@ -192,63 +370,163 @@ class Neotags(object):
         if (ft == '' or ft in self.__ignore):
             return
 
-        if (self.__is_running):
-            return
-        self.__is_running = True
+        token = self._start_job()
+        if not self._run_job(token, self._highlight_job, ft, token, force):
+            # The buffer was edited while we were busy: try once more with
+            # the new contents rather than leaving it unhighlighted.
+            if token.reason == 'buffer modified' and not requeued:
+                self.submit(HIGHLIGHT, ('highlight', token.buffer),
+                            self.highlight, clear, True)
 
+    def _highlight_job(self, ft, token, force):
         self._debug_start()
+        job_start = time.time()
+        self.__pending.pop(token.buffer, None)
         file = self.__vim.api.eval("expand('%:p:p')")
 
-        if self.__vim.current.buffer.number not in self.__seen \
+        if token.buffer not in self.__seen \
                 or ft not in self.__groups or force:
             self._debug_echo("Forcing an update!")
-            self._update(ft)
+            self._update(ft, token)
             force = True
 
+        # The budget and the latency cover sending the syntax, not ctags.
+        apply_start = time.time()
         order = self._tags_order(ft)
         groups = self.__groups[ft]
 
         if groups is None:
             self._debug_echo("Skipping file", False)
-            self.__is_running = False
             return
 
         if not order:
             order = groups.keys()
 
+        units = self._highlight_units(order, groups)
+        deadline = None
+
+        if self._is_large(token, groups):
+            # Cheap keyword kinds go first, then the regex ones. What does
+            # not fit into the budget is finished in later idle slices.
+            units.sort(key=lambda unit: not self._is_keyword(unit))
+            deadline = apply_start + self.__budget / 1000.0
+            self._debug_echo("Large file mode for buffer %d" % token.buffer,
+                             False)
+
+        self._apply_units(token, ft, file, units, force, deadline)
+        if token.buffer in self.__windows:
+            self._highlight_windows(ft, token)
+        self._debug_end('applied syntax for %s' % ft)
+
+        if token.buffer not in self.__pending:
+            self.__latency[token.buffer] = (time.time() - apply_start) * 1000
+        self.__stats['highlight.last'] = time.time() - job_start
+
+        self.__hlbuf = token.buffer
+
+        self.__current_file = file
+
+    def idle(self):
+        """Continue a highlight that ran out of its time budget, or else an
+        index that is being built in batches."""
+        self.__idle_scheduled = False
+        if not self.__pending:
+            if self.__resumable and self.__job is None:
+                self._resume()
+            return
+        if self.__job is not None:
+            self._schedule_idle()
+            return
+
+        token = self._start_job()
+        pending = self.__pending.get(token.buffer)
+
+        if pending is None or pending[0] != token.filetype:
+            self.__job = None
+            return
+
+        del self.__pending[token.buffer]
+        self._run_job(token, self._idle_job, token, pending)
+
+    def _idle_job(self, token, pending):
+        ft, file, units, force, parts = pending
+        deadline = time.time() + self.__budget / 1000.0
+        self._apply_units(token, ft, file, units, force, deadline, parts)
+
+    def _apply_units(self, token, ft, file, units, force, deadline,
+                     parts=()):
+        """Send the syntax for units, each as a single command. With a
+        deadline a unit is sent in parts of g:neotags_patternlength names
+        instead, and once the deadline has passed the rest is left to an
+        idle slice. parts are the remaining parts of a unit cut short."""
+        parts = list(parts)
+        i = sent = 0
+
+        while parts or i < len(units):
+            if deadline is not None and sent and time.time() > deadline:
+                self.__pending[token.buffer] = (ft, file, units[i:], force,
+                                                parts)
+                self._schedule_idle()
+                self._debug_echo("Deferring %d highlight groups"
+                                 % (len(units) - i + bool(parts)), False)
+                return
+
+            if not parts:
+                key, hlgroup, group, prefix, suffix, notin = units[i]
+                i += 1
+                cmds = self._highlight(key, file, ft, hlgroup, group,
+                                       prefix, suffix, notin, force, token)
+                if not cmds:
+                    continue
+                parts = [cmds] if deadline is None else _split_cmds(cmds)
+
+            token.check()
+            self.__vim.command(' | '.join(parts.pop(0)), async=True)
+            sent += 1
+
+    def _highlight_units(self, order, groups):
+        units = []
+
         for key in order:
             hlgroup = self._exists(key, '.group', None)
             fgroup = self._exists(key, '.filter.group', None)
 
             if hlgroup is not None and key in groups:
-                prefix = self._exists(key, '.prefix', self.__prefix)
-                suffix = self._exists(key, '.suffix', self.__suffix)
-                notin = self._exists(key, '.notin', [])
-
-                if not self._highlight(key, file, ft, hlgroup, groups[key],
-                                       prefix, suffix, notin, force):
-                    break
-
-                # self._debug_echo('applied syntax for %s' % key)
+                units.append((
+                    key, hlgroup, groups[key],
+                    self._exists(key, '.prefix', self.__prefix),
+                    self._exists(key, '.suffix', self.__suffix),
+                    self._exists(key, '.notin', [])
+                ))
 
             fkey = key + '_filter'
             if fgroup is not None and fkey in groups:
-                prefix = self._exists(key, '.filter.prefix', self.__prefix)
-                suffix = self._exists(key, '.filter.suffix', self.__suffix)
-                notin = self._exists(key, '.filter.notin', [])
+                units.append((
+                    fkey, fgroup, groups[fkey],
+                    self._exists(key, '.filter.prefix', self.__prefix),
+                    self._exists(key, '.filter.suffix', self.__suffix),
+                    self._exists(key, '.filter.notin', [])
+                ))
 
-                if not self._highlight(fkey, file, ft, fgroup, groups[fkey],
-                                       prefix, suffix, notin, force):
-                    break
+        return units
 
-                # self._debug_echo('applied syntax for %s' % fkey)
+    def _is_keyword(self, unit):
+        return unit[3] == self.__prefix and unit[4] == self.__suffix
 
-        self._debug_end('applied syntax for %s' % ft)
+    def _is_large(self, token, groups):
+        if self.__budget <= 0:
+            return False
 
-        self.__hlbuf = self.__vim.current.buffer.number
+        lines, tags, latency = self.__largefile
+        return (len(self.__vim.current.buffer) >= lines
+                or sum(len(g) for g in groups.values() if g) >= tags
+                or self.__latency.get(token.buffer, 0) >= latency)
 
-        self.__current_file = file
-        self.__is_running = False
+    def _schedule_idle(self):
+        if not self.__idle_scheduled:
+            self.__idle_scheduled = True
+            self.__vim.command('call timer_start(%d, {-> NeotagsIdle()})'
+                               % self.__idle_delay, async=True)
 
 ##############################################################################
     # Projects
@@ -295,17 +573,604 @@ class Neotags(object):
             self._inform_echo("Error: directory '%s' is not a known project"
                               " base." % path)
 
+##############################################################################
+    # Startup prewarming
+
+    def _start_prewarm(self, highlight):
+        """Load or refresh the indexes of all saved projects on a background
+        thread, starting with the project of the current buffer, which is
+        highlighted once its index is ready if highlight is set. Everything
+        the thread needs from nvim is read here, as the API must not be used
+        from outside the main loop."""
+        File = os.path.realpath(self.__vim.api.eval("expand('%:p')"))
+        recurse, path = self._project_for(File)
+        settings = {
+            'args': self.__vim.vars['neotags_ctags_args'],
+            'bin': self.__vim.vars['neotags_ctags_bin'],
+            'recursive': self.__vim.vars['neotags_recursive'],
+            'timeout': self.__vim.vars['neotags_ctags_timeout'],
+            'first': path if recurse else None,
+            'highlight': highlight,
+            'library': False,
+        }
+        self.__prewarm_thread = threading.Thread(target=self._prewarm,
+                                                 args=(settings,))
+        self.__prewarm_thread.daemon = True
+        self.__prewarm_thread.start()
+
+    def _prewarm(self, settings):
+        start = time.time()
+        self.__stats['startup.imports'] = _load_modules()
+
+        try:
+            with open(self.__settingsFile, 'r') as fp:
+                projects = [i.rstrip() for i in fp if i.strip()]
+        except FileNotFoundError:
+            projects = []
+
+        if not settings['recursive']:
+            projects = []
+
+        first = settings['first']
+        if first in projects:
+            projects.remove(first)
+            projects.insert(0, first)
+        else:
+            first = None
+            self._prewarmed(settings)
+
+        for path in projects:
+            proj_start = time.time()
+            tagfile = self._tagfile_for(path)
+
+            try:
+                if tagindex.read_checkpoint(tagfile) is not None:
+                    # Left to the batches run when idle (see _resume).
+                    state = 'indexing in batches'
+                elif not self._index_is_stale(path,
+                                              self._index_path(tagfile)):
+                    state = 'loaded'
+                elif self._background_ctags(path, tagfile, settings):
+                    state = 'refreshed'
+                else:
+                    state = 'timed out'
+
+                if state in ('loaded', 'refreshed'):
+                    # Only the current project is kept in memory; the
+                    # others are just brought up to date on disk.
+                    if path == first:
+                        for File in self._all_index_files(tagfile):
+                            self._read_index(File)
+                    self.__fresh.add(tagfile)
+            except (IOError, OSError) as err:
+                state = 'failed (%s)' % err
+
+            self.__stats['startup.prewarm.%s' % path] = '%.3fs (%s)' % (
+                time.time() - proj_start, state)
+            if path == first:
+                self._prewarmed(settings)
+            time.sleep(PREWARM_PAUSE)
+
+        self.__stats['startup.prewarm'] = time.time() - start
+
+    def _prewarmed(self, settings):
+        """Highlight the current buffer now that the index of its project is
+        ready, rather than have it run ctags alongside the prewarm."""
+        if settings['highlight']:
+            self.submit(HIGHLIGHT, ('highlight', None), self.highlight, False)
+
+    def _index_is_stale(self, path, index):
+        """An index is stale if it is missing or if any file in the project
+        has been modified since it was written."""
+        try:
+            mtime = os.path.getmtime(index)
+        except OSError:
+            return True
+
+        for root, dirs, files in os.walk(path):
+            dirs[:] = [d for d in dirs if not d.startswith('.')]
+            for name in files:
+                try:
+                    if os.path.getmtime(os.path.join(root, name)) > mtime:
+                        return True
+                except OSError:
+                    continue
+
+        return False
+
+    def _background_ctags(self, path, tagfile, settings):
+        # Write to a private file so as not to race a foreground ctags run.
+        tmpfile = tagfile + '.partial'
+        full_command = self._ctags_command(tmpfile, path, True, None,
+                                           list(settings['args']),
+                                           settings['bin'])
+        proc = subprocess.Popen(
+            full_command, shell=True, stderr=subprocess.DEVNULL,
+            preexec_fn=(None if platform == 'win32' else _lower_priority)
+        )
+
+        try:
+            proc.wait(settings['timeout'])
+        except subprocess.TimeoutExpired:
+            try:
+                self._kill(proc.pid)
+            except ImportError:
+                proc.kill()
+            try:
+                os.unlink(tmpfile)
+            except OSError:
+                pass
+            return False
+
+        with open(tmpfile, 'rb') as src:
+            self._store_index(src, tagfile, path, settings['library'])
+        os.unlink(tmpfile)
+        return True
+
+##############################################################################
+    # Library indexes
+
+    def _start_library(self):
+        """Build or refresh the shared indexes of g:neotags_library_dirs on a
+        background thread."""
+        settings = {
+            'args': self.__vim.vars['neotags_ctags_args'],
+            'bin': self.__vim.vars['neotags_ctags_bin'],
+            'timeout': None,
+            'library': True,
+        }
+        self.__library_thread = threading.Thread(target=self._build_library,
+                                                 args=(settings,))
+        self.__library_thread.daemon = True
+        self.__library_thread.start()
+
+    def _build_library(self, settings):
+        _load_modules()
+        directory = self._library_directory()
+        if not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+
+        for path in self.__library_dirs:
+            start = time.time()
+            tagfile = self._tagfile_for(path, directory)
+
+            try:
+                signature = _tree_signature(path)
+                if (os.path.exists(tagindex.manifest_path(tagfile))
+                        and _read_signature(tagfile) == signature):
+                    state = 'up to date'
+                elif self._background_ctags(path, tagfile, settings):
+                    _write_signature(tagfile, signature)
+                    state = 'built'
+                    if os.path.exists(tagfile + SUFFIX):
+                        # Left over from before libraries were sharded.
+                        os.unlink(tagfile + SUFFIX)
+                else:
+                    state = 'timed out'
+            except (IOError, OSError) as err:
+                state = 'failed (%s)' % err
+
+            self.__stats['library.%s' % path] = '%.3fs (%s)' % (
+                time.time() - start, state)
+
+    def _library_directory(self):
+        return os.path.join(self.__directory, 'library')
+
+    def _library_tagfiles(self):
+        """The tag files of the library directories that have been indexed.
+        One that is being rebuilt is used as it was until it is replaced.
+        Library indexes are always sharded, so that only the languages of
+        the current filetype are read."""
+        directory = self._library_directory()
+        tagfiles = [self._tagfile_for(path, directory)
+                    for path in self.__library_dirs]
+        return [tagfile for tagfile in tagfiles
+                if os.path.exists(tagindex.manifest_path(tagfile))]
+
+    def _library_groups(self, ft, token):
+        """The unfiltered groups of every library index with tags for ft,
+        each parsed once and kept until its shards change."""
+        libraries = []
+        for library in self._library_tagfiles():
+            files = tagindex.select_shards(library, self._shard_languages(ft))
+            if files:
+                groups = self._full_groups(files, ft, token, library)
+                if groups is not None:
+                    libraries.append(groups)
+        return libraries
+
+    def _add_libraries(self, ft, token, groups, check):
+        """Merge the tags of the library indexes that pass check into the
+        groups of the project."""
+        if groups is None:
+            return None
+
+        libraries = [library.select(check)
+                     for library in self._library_groups(ft, token)]
+        if not libraries:
+            return groups
+        return self._merge_groups(ft, token, [groups] + libraries)
+
+    def _merge_groups(self, ft, token, parts):
+        """Combine several TagGroups into new ones. The parts may share the
+        frozen table of a cached parse, which must not be added to."""
+        groups = TagGroups()
+        for part in parts:
+            for key, group in part.items():
+                groups.ensure(key)
+                for name in group:
+                    groups.add(key, name)
+        return self._clean_groups(ft, groups, token)
+
+##############################################################################
+    # Checkpointed indexing
+
+    def _resume(self):
+        _load_modules()
+        ft = self.__vim.api.eval('&ft')
+        if (not self.__vim.vars['neotags_enabled']
+                or ft == '' or ft in self.__ignore):
+            return
+
+        token = self._start_job()
+        self._run_job(token, self._resume_job, ft, token)
+
+    def _resume_job(self, ft, token):
+        recurse, path, tagfile = self._get_file()
+        if not recurse or tagfile not in self.__resumable:
+            return
+
+        self._resume_index(path, tagfile)
+        token.check()
+
+        # Highlight with what has been indexed so far. Until the buffer is
+        # written the next batch is left to the next idle period.
+        self.__fresh.add(tagfile)
+        self._highlight_job(ft, token, True)
+
+    def _start_batches(self, path, tagfile):
+        """Set up indexing path in batches after ctags -R timed out."""
+        File = os.path.realpath(self.__vim.api.eval("expand('%:p')"))
+        files = self._list_files(path, os.path.dirname(File))
+        checkpoint = tagindex.start_checkpoint(tagfile, path, files,
+                                               self.__batch)
+        self.__resumable.add(tagfile)
+        self._checkpoint_stats(checkpoint)
+
+    def _list_files(self, path, near):
+        """The files ctags -R would visit, those next to the current file
+        first so that they are highlighted after the first batch."""
+        if self.__find_tool:
+            out = subprocess.check_output(
+                '%s "%s"' % (self.__find_tool, path), shell=True,
+                stderr=subprocess.DEVNULL)
+            files = [os.path.join(path, name) for name in
+                     out.decode('utf8', 'surrogateescape').splitlines()
+                     if name]
+        else:
+            files = []
+            for root, dirs, names in os.walk(path):
+                dirs[:] = [d for d in dirs if not d.startswith('.')
+                           and os.path.join(root, d) not in self.__library_dirs]
+                files += [os.path.join(root, name) for name in names]
+
+        near = os.path.join(near, '')
+        files.sort(key=lambda name: (not name.startswith(near), name))
+        return files
+
+    def _resume_index(self, path, tagfile):
+        """Carry on indexing path from its checkpoint with one batch, leaving
+        the rest to later idle periods. Returns False if there is no
+        checkpoint for path."""
+        checkpoint = tagindex.read_checkpoint(tagfile)
+        if checkpoint is None or checkpoint['root'] != path:
+            if checkpoint is not None:
+                tagindex.clear_checkpoint(tagfile)
+            self.__resumable.discard(tagfile)
+            return False
+
+        self.__resumable.add(tagfile)
+        if checkpoint['done'] < checkpoint['total']:
+            self._index_batch(tagfile, checkpoint,
+                              tagindex.read_filelist(tagfile),
+                              self.__vim.vars['neotags_ctags_timeout'])
+
+        self._debug_echo("Indexed %d of %d files of '%s'"
+                         % (checkpoint['done'], checkpoint['total'], path),
+                         False)
+        if checkpoint['done'] >= checkpoint['total']:
+            self._finish_index(tagfile, checkpoint)
+        self._checkpoint_stats(checkpoint)
+        return True
+
+    def _index_batch(self, tagfile, checkpoint, files, timeout):
+        """Run ctags over the next batch of files and append its output to
+        the pending index. A batch that times out is halved and tried again;
+        a single file that times out is skipped."""
+        done = checkpoint['done']
+        batch = files[done:done + checkpoint['batch']]
+        listfile = tagfile + '.batch'
+        outfile = tagfile + '.batch.tags'
+
+        with open(listfile, 'w', errors='surrogateescape') as fp:
+            fp.writelines(name + '\n' for name in batch)
+
+        full_command = self._ctags_command(
+            outfile, checkpoint['root'], False, None,
+            self.__vim.vars['neotags_ctags_args'] + ['--sort=no'],
+            self.__vim.vars['neotags_ctags_bin'], listfile
+        )
+        self._debug_echo(full_command, False)
+        start = time.time()
+
+        try:
+            proc = subprocess.Popen(full_command, shell=True,
+                                    stderr=subprocess.DEVNULL)
+            proc.wait(timeout)
+        except subprocess.TimeoutExpired:
+            try:
+                self._kill(proc.pid)
+            except ImportError:
+                proc.kill()
+
+            if len(batch) > 1:
+                checkpoint['batch'] = max(len(batch) // 2, 1)
+            else:
+                checkpoint['skipped'] += batch
+                checkpoint['done'] = done + 1
+            tagindex.write_checkpoint(tagfile, checkpoint)
+            return
+
+        try:
+            with open(outfile, 'rb') as fp:
+                tagindex.append_pending(tagfile, checkpoint, fp.read())
+            os.unlink(outfile)
+        except IOError as err:
+            self._error("Unexpected IO Error -> '%s'" % err)
+            return
+        finally:
+            os.unlink(listfile)
+
+        checkpoint['done'] = done + len(batch)
+        checkpoint['batches'] += 1
+        if time.time() - start < timeout / 4.0:
+            checkpoint['batch'] = len(batch) * 2
+        tagindex.write_checkpoint(tagfile, checkpoint)
+
+    def _finish_index(self, tagfile, checkpoint):
+        """Sort the output of all batches into the index proper."""
+        data = tagindex.finish_pending(tagfile)
+        self._store_index(io.BytesIO(data), tagfile, checkpoint['root'])
+        self.update_vim_tagfile(self._index_path(tagfile),
+                                io.StringIO(data.decode('utf8', 'replace')))
+        tagindex.clear_checkpoint(tagfile)
+        self.__resumable.discard(tagfile)
+
+    def _checkpoint_stats(self, checkpoint):
+        if checkpoint['done'] >= checkpoint['total']:
+            state = 'done'
+        else:
+            state = '%d/%d files' % (checkpoint['done'], checkpoint['total'])
+        if checkpoint['skipped']:
+            state += ', %d skipped' % len(checkpoint['skipped'])
+        self.__stats['index.%s' % checkpoint['root']] = '%s in %d batches' % (
+            state, checkpoint['batches'])
+
+##############################################################################
+    # Multiple windows
+
+    def _window_groups(self, files, ft, token, tagfile):
+        """Filter the unfiltered groups of the project and of the libraries
+        for the current buffer and for the other visible buffers of the same
+        project and filetype. Returns the groups of the current buffer and
+        keeps the others for _highlight_windows()."""
+        slurp = self._slurp(token)
+        full = self._full_groups(files, ft, token, tagfile)
+        if full is None:
+            return None
+        libraries = self._library_groups(ft, token)
+
+        self._debug_start()
+        buffers = [(None, token.buffer, slurp)]
+        buffers += self._visible_buffers(ft, token.buffer, tagfile)
+
+        results = []
+        for _, _, text in buffers:
+            self._poll(token)
+            check = self._tag_filter(text)
+            parts = [groups.select(check) for groups in [full] + libraries]
+            results.append(parts[0] if len(parts) == 1
+                           else self._merge_groups(ft, token, parts))
+
+        self.__windows[token.buffer] = [
+            (window, number, groups) for (window, number, _), groups
+            in zip(buffers[1:], results[1:])
+        ]
+        self.__stats['engine.last'] = 'python (%d windows)' % len(buffers)
+        self._debug_end('Filtered tags for %d buffers' % len(buffers))
+        return results[0]
+
+    def _full_groups(self, files, ft, token, tagfile):
+        """All tags of the index files for ft, parsed once and kept until
+        one of the files changes. Only the FULL_GROUPS most recently used
+        are kept."""
+        stamp = tuple((File, os.path.getmtime(File)) for File in files
+                      if os.path.exists(File))
+        key = (tagfile, ft)
+        cached = self.__full_groups.get(key)
+        if cached is not None and cached[0] == stamp:
+            self.__full_groups.move_to_end(key)
+            return cached[1]
+
+        groups = self._getTags(files, ft, token, lambda tag: True)
+        if groups is not None:
+            groups.freeze()
+            self.__full_groups[key] = (stamp, groups)
+            self.__full_groups.move_to_end(key)
+            while len(self.__full_groups) > FULL_GROUPS:
+                self.__full_groups.popitem(last=False)
+        return groups
+
+    def _visible_buffers(self, ft, current_buffer, tagfile):
+        """The other windows of the current tab page that show a buffer of
+        the project of tagfile with filetype ft, as (window, buffer number,
+        text) tuples. Each buffer is listed once."""
+        current = self.__vim.api.get_current_win()
+        windows = [window for window in self.__vim.api.tabpage_list_wins(0)
+                   if window != current]
+        if not windows:
+            return []
+
+        shown = {}
+        for window, buf in zip(windows, self._atomic(
+                [['nvim_win_get_buf', [window]] for window in windows])):
+            if buf.number != current_buffer:
+                shown.setdefault(buf.number, (window, buf))
+
+        calls = []
+        for window, buf in shown.values():
+            calls += [['nvim_buf_get_option', [buf, 'filetype']],
+                      ['nvim_buf_get_name', [buf]],
+                      ['nvim_buf_get_lines', [buf, 0, -1, False]]]
+        info = self._atomic(calls)
+        # A window may have closed since; the results stop at its buffer.
+        shown = list(shown.values())[:len(info) // 3]
+
+        buffers = []
+        for i, (window, buf) in enumerate(shown):
+            filetype, name, lines = info[3 * i:3 * i + 3]
+            if filetype != ft or not name:
+                continue
+
+            File = os.path.realpath(name)
+            recurse, path = self._project_for(File)
+            if self._tagfile_for(path if recurse else File) != tagfile:
+                continue
+            buffers.append((window, buf.number, ' '.join(lines)))
+
+        return buffers
+
+    def _highlight_windows(self, ft, token):
+        """Apply the groups filtered for the other visible buffers with one
+        request, running the syntax commands in each window. The commands
+        are also cached, as for a buffer that was highlighted itself."""
+        windows = self.__windows.pop(token.buffer, [])
+        order = self._tags_order(ft)
+        calls = []
+
+        for window, number, groups in windows:
+            md5_cache = self.__md5_cache.setdefault(number, {})
+            cmd_cache = self.__cmd_cache.setdefault(number, {})
+            cmds = []
+
+            for key, hlgroup, group, prefix, suffix, notin in \
+                    self._highlight_units(order or groups.keys(), groups):
+                hlkey = '_Neotags_%s_%s' % (key.replace('#', '_'), hlgroup)
+                cached = (hlgroup, group, prefix, suffix)
+                cmds += self._highlight_cmds(hlkey, *cached)
+                md5_cache[hlkey] = group.digest()
+                cmd_cache[hlkey] = cached
+
+            calls.append(['nvim_call_function',
+                          ['win_execute', [window.handle, cmds, 'silent']]])
+            if number not in self.__seen:
+                self.__seen.append(number)
+
+        token.check()
+        self._atomic(calls)
+        self._debug_echo('Highlighted %d other windows' % len(calls), False)
+
+    def _atomic(self, calls):
+        """Send calls in one nvim_call_atomic request and return the
+        results; those after a failed call are missing."""
+        if not calls:
+            return []
+        results, error = self.__vim.api.call_atomic(calls)
+        if error is not None:
+            self._error('Failed to update other windows: %s' % error[2])
+        return results
+
 ##############################################################################
     # Private
 
-    def _update(self, ft):
-        self.__seen.append(self.__vim.current.buffer.number)
-        self._run_ctags()
-        self.__groups[ft] = self._parseTags(ft)
+    def _start_job(self):
+        """Create the token for a new highlight or update, preempting
+        whatever job is still in flight."""
+        token = CancelToken(*self.__vim.api.eval(STATE_EXPR))
+        if self.__job is not None:
+            self.__job.cancel()
+        self.__job = token
+        return token
+
+    def _run_job(self, token, func, *args):
+        """Run func, returning False if it was cancelled part way."""
+        timings = self._timings()
+        depth = len(timings)
+        try:
+            func(*args)
+            return True
+        except JobCancelled as err:
+            self._debug_echo("Discarded job for buffer %d (%s)"
+                             % (token.buffer, err), False)
+            return False
+        finally:
+            del timings[depth:]
+            if self.__job is token:
+                self.__job = None
+
+    def _verify(self, token):
+        token.verify(*self.__vim.api.eval(STATE_EXPR))
+
+    def _poll(self, token):
+        """Check token from inside a long loop. Every POLL_INTERVAL seconds
+        the state of nvim is verified instead: waiting for the reply lets the
+        requests that came in meanwhile be handled, and one of them may
+        cancel the job (see submit)."""
+        if time.time() - token.polled < POLL_INTERVAL:
+            token.check()
+        else:
+            token.polled = time.time()
+            self._verify(token)
+
+    def _update(self, ft, token, force=False):
+        recurse, path, tagfile = self._get_file()
+        self.__windows.pop(token.buffer, None)
+
+        groups = None
+        fresh = tagfile in self.__fresh
+        # A prewarmed index only stands in for the first ctags run.
+        self.__fresh.discard(tagfile)
+        if fresh and not force:
+            self._debug_echo("Using prewarmed index '%s'" % tagfile, False)
+        elif self.__stream:
+            groups = self._stream_ctags(ft, token, recurse, path, tagfile,
+                                        incremental=force)
+            if self.__multiwindow:
+                # The streamed groups only hold the tags for the current
+                # buffer.
+                groups = None
+        else:
+            self._run_ctags(recurse, path, tagfile, incremental=force)
+        token.check()
+
+        if groups is None:
+            groups = self._parseTags(ft, token, recurse, path, tagfile)
+        token.check()
+
+        if groups is not None:
+            groups.freeze()
+            self.__stats['groups.%s' % ft] = groups.usage()
 
-    def _highlight(self, key, file, ft, hlgroup, group, prefix, suffix, notin, force):
+        # Only publish the result once the job is known to be current.
+        self.__groups[ft] = groups
+        if token.buffer not in self.__seen:
+            self.__seen.append(token.buffer)
+
+    def _highlight(self, key, file, ft, hlgroup, group, prefix, suffix, notin,
+                   force, token):
         self._debug_start()
-        highlights, number = self._getbufferhl()
+        self._verify(token)
+        number = token.buffer
 
         self._debug_echo("Highlighting for buffer %s" % number)
         if number in self.__md5_cache:
@@ -313,118 +1178,146 @@ class Neotags(object):
         else:
             self.__md5_cache[number] = highlights = {}
 
-        current = []
-        cmds = []
         hlkey = '_Neotags_%s_%s' % (key.replace('#', '_'), hlgroup)
 
         # self._debug_echo(str(group))
 
-        md5 = hashlib.md5()
-        strgrp = ''.join(group).encode('utf8')
-
-        for i in range(0, len(strgrp), 128):
-            md5.update(strgrp[i:i + 128])
-
-        md5hash = md5.hexdigest()
+        md5hash = group.digest()
 
         if not force  \
             and (hlkey in highlights and md5hash == highlights[hlkey]) \
             or (number != self.__hlbuf and number in self.__cmd_cache
                 and hlkey in self.__cmd_cache[number]):
             try:
-                cmds = self.__cmd_cache[number][hlkey]
+                cached = self.__cmd_cache[number][hlkey]
             except KeyError:
                 self._error('Key error in _highlight()!')
-                return True
-            self._debug_echo("Updating from cache" % cmds)
+                return
+            self._debug_echo("Updating from cache")
         else:
-            cmds.append('silent! syntax clear %s' % hlkey)
-
-            for i in range(0, len(group), self.__patternlength):
-                current = group[i:i + self.__patternlength]
-
-                if prefix == self.__prefix and suffix == self.__suffix:
-                    cmds.append(self.__keyword_pattern %
-                                (hlkey, ' '.join(current)))
-                else:
-                    cmds.append(self.__match_pattern %
-                                (hlkey, prefix, '\|'.join(current), suffix))
-
-                # if prefix == self.__prefix and suffix == self.__suffix:
-                #     cmds.append(self.__keyword_pattern % (
-                #         hlkey,
-                #         ' '.join(current),
-                #         ','.join(self.__notin + notin)
-                #     ))
-                # else:
-                #     cmds.append(self.__match_pattern % (
-                #         hlkey,
-                #         prefix,
-                #         '\|'.join(current),
-                #         suffix,
-                #         ','.join(self.__notin + notin)
-                #     ))
-
-            if ft != self.__vim.api.eval('&ft'):
-                self._debug_end('filetype changed aborting highlight')
-                return False
-
+            cached = (hlgroup, group, prefix, suffix)
             self.__md5_cache[number][hlkey] = md5hash
-            cmds.append('hi link %s %s' % (hlkey, hlgroup))
 
-        full_cmd = ' | '.join(cmds)
-        # self._debug_echo("Sending command %s" % full_cmd)
-
-        self.__vim.command(full_cmd, async=True)
+        cmds = self._highlight_cmds(hlkey, *cached)
+        # self._debug_echo("Sending command %s" % ' | '.join(cmds))
 
+        # Only the group is kept, the commands are rebuilt from it.
         try:
-            self.__cmd_cache[number][hlkey] = cmds
+            self.__cmd_cache[number][hlkey] = cached
         except KeyError:
             self.__cmd_cache[number] = {}
-            self.__cmd_cache[number][hlkey] = cmds
+            self.__cmd_cache[number][hlkey] = cached
 
         self._debug_end('Updated highlight for %s' % hlkey)
-        return True
+        return cmds
 
-    def _parseTags(self, ft):
-        self._get_file()
-        comp_file = self.__tagfile + SUFFIX
+    def _highlight_cmds(self, hlkey, hlgroup, group, prefix, suffix):
+        """Build the syntax commands for a group, joining its names straight
+        from the tag table."""
+        cmds = ['silent! syntax clear %s' % hlkey]
+
+        for i in range(0, len(group), self.__patternlength):
+            stop = i + self.__patternlength
+
+            if prefix == self.__prefix and suffix == self.__suffix:
+                cmds.append(self.__keyword_pattern %
+                            (hlkey, group.join(' ', i, stop)))
+            else:
+                cmds.append(self.__match_pattern %
+                            (hlkey, prefix, group.join('\\|', i, stop),
+                             suffix))
+
+            # if prefix == self.__prefix and suffix == self.__suffix:
+            #     cmds.append(self.__keyword_pattern % (
+            #         hlkey,
+            #         ' '.join(current),
+            #         ','.join(self.__notin + notin)
+            #     ))
+            # else:
+            #     cmds.append(self.__match_pattern % (
+            #         hlkey,
+            #         prefix,
+            #         '\\|'.join(current),
+            #         suffix,
+            #         ','.join(self.__notin + notin)
+            #     ))
+
+        cmds.append('hi link %s %s' % (hlkey, hlgroup))
+        return cmds
+
+    def _parseTags(self, ft, token, recurse, path, tagfile):
+        index = self._index_path(tagfile)
 
         self._debug_start()
-        self._debug_echo("Using tags file %s" % comp_file)
+        self._debug_echo("Using tags file %s" % index)
 
-        if not os.path.exists(comp_file):
+        if not os.path.exists(index) and tagfile not in self.__resumable:
             self._debug_echo("Tags file does not exist. Running ctags.")
-            self._run_ctags()
+            self._run_ctags(recurse, path, tagfile)
+            files = self._index_files(tagfile, ft)
         else:
             self._debug_echo('updating vim-tagfile', False)
-            with gzip.open(comp_file, 'rt', encoding='utf8', errors='replace') as File:
-                self.update_vim_tagfile(comp_file, File)
+            files = self._index_files(tagfile, ft)
+            if not os.path.exists(index):
+                self._debug_echo('index is still being built in batches',
+                                 False)
+            elif self.__sharded:
+                text = ''.join(self._read_index(File).decode('utf8', 'replace')
+                               for File in self._select_index(tagfile, ft))
+                self.update_vim_tagfile(index, io.StringIO(text))
+            else:
+                with gzip.open(index, 'rt', encoding='utf8', errors='replace') as File:
+                    self.update_vim_tagfile(index, File)
 
         self._debug_end("Finished updating file list")
 
-        files = [self.__tagfile]
-
         if files is None:
             self._error("echom 'No tag files found!'")
             return
+        self._trim_index_cache(files)
 
-        # Slurp the whole content of the current buffer
-        self._debug_start()
-        self.__slurp = ' '.join(self.__vim.current.buffer)
-        self._debug_end("Finished updating slurp")
+        if self.__multiwindow:
+            return self._window_groups(files, ft, token, tagfile)
+        return self._run_engine(self._engine_for(files), files, ft, token)
 
+    def _engine_for(self, files):
+        """Pick the tag engine for a set of index files. The C binary only
+        pays off once the indexes are large enough to outweigh the cost of
+        spawning it (see tools/engine_bench.py)."""
         if self.__neotags_bin is None:
+            return 'python'
+
+        size = sum(os.path.getsize(File) for File in files
+                   if os.path.exists(File))
+        if size < self.__bin_threshold:
+            return 'python'
+        return 'binary'
+
+    def _run_engine(self, engine, files, ft, token):
+        slurp = self._slurp(token)
+        check = self._tag_filter(slurp)
+
+        self.__stats['engine.last'] = engine
+        if engine == 'python':
             self._debug_echo("Using python code to analyze tags.", False)
-            return self._getTags(files, ft)
+            groups = self._getTags(files, ft, token, check)
         else:
             self._debug_echo("Using C binary to analyze tags.", False)
-            return self._bin_getTags(files, ft)
+            groups = self._bin_getTags(files, ft, token, slurp)
+        return self._add_libraries(ft, token, groups, check)
+
+    def _slurp(self, token):
+        # Slurp the whole content of the current buffer
+        self._debug_start()
+        self._verify(token)
+        slurp = ' '.join(self.__vim.current.buffer)
+        self._debug_end("Finished updating slurp")
+        return slurp
 
 # =============================================================================
     # Yes C binary
 
-    def _bin_getTags(self, files, ft):
+    def _bin_getTags(self, files, ft, token, slurp):
         filetypes = ft.lower().split('.')
         languages = ft.lower().split('.')
 
@@ -434,90 +1327,113 @@ class Neotags(object):
         except NvimError:
             return
 
-        groups = {
-            "%s#%s" % (ft, kind): []
-            for kind in [chr(i) for i in order.encode('ascii')]
-        }
+        groups = TagGroups()
+        for kind in [chr(i) for i in order.encode('ascii')]:
+            groups.ensure("%s#%s" % (ft, kind))
 
         if filetypes is None:
             return groups
 
-        File = files[0] + SUFFIX
+        # The binary reads exactly this many bytes of buffer text.
+        slurp = slurp.encode('utf-8')
 
-        self._debug_start()
-        if (os.stat(File).st_size == 0):
-            return
+        for File in files:
+            if (os.stat(File).st_size == 0):
+                continue
+            self._debug_start()
 
-        proc = subprocess.Popen((self.__neotags_bin,
-                                 File,
-                                 lang,
-                                 order,
-                                 str(len(self.__slurp)),
-                                 str(len(self.__ignored_tags)),
-                                 str(len(self.__ctov) * 2),
-                                 ':'.join(self.__ignored_tags) + ':',
-                                 ':'.join([i for sub in self.__ctov.items()
-                                           for i in sub]) + ':'
-                                 ),
-                                stdin=subprocess.PIPE,
-                                stderr=subprocess.PIPE,
-                                stdout=subprocess.PIPE)
-        out, err = proc.communicate(input=self.__slurp.encode('utf-8'))
-
-        self._debug_end('done reading %s' % File)
-        out = out.decode().split('\n')
-
-        for s in out:
-            self._debug_echo("OUT: %s" % s, False)
-        err = err.decode().split('\n')
-        for s in err:
-            self._debug_echo("ERR: %s" % s, False)
-
-        for i in range(0, len(out) - 1, 2):
-            key = "%s#%s" % (ft, out[i].rstrip('\r'))
-            try:
-                groups[key].append(out[i + 1].rstrip('\r'))
-            except KeyError:
-                groups[key] = [out[i + 1].rstrip('\r')]
+            proc = subprocess.Popen((self.__neotags_bin,
+                                     File,
+                                     lang,
+                                     order,
+                                     str(len(slurp)),
+                                     str(len(self.__ignored_tags)),
+                                     str(len(self.__ctov) * 2),
+                                     ':'.join(self.__ignored_tags) + ':',
+                                     ':'.join([i for sub in self.__ctov.items()
+                                               for i in sub]) + ':'
+                                     ),
+                                    stdin=subprocess.PIPE,
+                                    stderr=subprocess.PIPE,
+                                    stdout=subprocess.PIPE)
+            out, err = self._communicate(proc, slurp, token)
+
+            self._debug_end('done reading %s' % File)
+            out = out.decode().split('\n')
+
+            for s in out:
+                self._debug_echo("OUT: %s" % s, False)
+            err = err.decode().split('\n')
+            for s in err:
+                self._debug_echo("ERR: %s" % s, False)
+
+            for i in range(0, len(out) - 1, 2):
+                if not i % CHECK_INTERVAL:
+                    self._poll(token)
+                groups.add("%s#%s" % (ft, out[i].rstrip('\r')),
+                           out[i + 1].rstrip('\r'))
 
         return groups
 
+    def _communicate(self, proc, data, token):
+        """proc.communicate(data), polling token while waiting. The process
+        is killed if the job is cancelled."""
+        while True:
+            try:
+                return proc.communicate(data, POLL_INTERVAL)
+            except subprocess.TimeoutExpired:
+                data = None
+
+            try:
+                self._poll(token)
+            except JobCancelled:
+                proc.kill()
+                proc.communicate()
+                raise
+
 # =============================================================================
     # No C binary
 
-    def _getTags(self, files, ft):
+    def _getTags(self, files, ft, token, check):
         filetypes = ft.lower().split('.')
         languages = ft.lower().split('.')
-        groups = {}
+        groups = TagGroups()
 
         if filetypes is None:
             return groups
 
-        lang = '|'.join(self._vim_to_ctags(filetypes))
-        pattern = re.compile(
-            b'(?:^|\n)(?P<name>[^\t]+)\t(?P<file>[^\t]+)\t\/(?P<cmd>.+)\/;"\t(?P<kind>\w)\tlanguage:(?P<lang>'
-            + bytes(lang, 'utf8') + b'(?:\w+)?)', re.IGNORECASE
-        )
+        pattern = self._tags_pattern(filetypes)
 
-        File = files[0] + SUFFIX
         self._debug_start()
-        if (os.stat(File).st_size == 0):
-            return
+        File = None
 
         try:
-            # with gzip.open(File, 'r', errors='replace', encoding=None) as fp:
-            with gzip.open(File, 'r') as fp:
-                # mf = mmap.mmap(fp.fileno(), 0,  access=mmap.ACCESS_READ)
-                mf = fp.read()
-                for match in pattern.finditer(mf):
-                    self._parseLine(match, groups, languages)
-                # mf.close()
+            for File in files:
+                if (os.stat(File).st_size == 0):
+                    continue
+                mf = self._read_index(File)
+                for i, match in enumerate(pattern.finditer(mf)):
+                    if not i % CHECK_INTERVAL:
+                        self._poll(token)
+                    self._parseLine(match, groups, languages, check)
         except IOError as e:
             self._error("could not read %s: %s" % (File, e))
             return
 
-        self._debug_end('done reading %s' % File)
+        self._debug_end('done reading %s' % ', '.join(files))
+
+        return self._clean_groups(ft, groups, token)
 
+    def _tags_pattern(self, filetypes):
+        lang = '|'.join(self._vim_to_ctags(filetypes))
+        return re.compile(
+            b'(?:^|\n)(?P<name>[^\t]+)\t(?P<file>[^\t]+)\t\/(?P<cmd>.+)\/;"\t(?P<kind>\w)\tlanguage:(?P<lang>'
+            + bytes(lang, 'utf8') + b'(?:\w+)?)', re.IGNORECASE
+        )
+
+    def _clean_groups(self, ft, groups, token):
+        """Remove tags from groups that also appear in a group of higher
+        priority."""
         order = self._tags_order(ft)
         if not order:
             order = list(groups.keys())
@@ -530,17 +1446,20 @@ class Neotags(object):
         for a in list(clean):
             if a not in groups:
                 continue
+            self._poll(token)
             for b in list(order):
                 if b not in groups or a == b:
                     continue
-                groups[a] = [x for x in groups[a] if x not in groups[b]]
+                groups[a] = groups[a].without(groups[b])
 
         self._debug_end('done cleaning groups')
 
         return groups
 
-    def _parseLine(self, match, groups, languages):
-        entry = {x: ''.join(map(chr, y)) for x, y in match.groupdict().items()}
+    def _parseLine(self, match, groups, languages, check):
+        # latin-1 maps each byte to the char of the same value, as chr() did.
+        entry = {x: match.group(x).decode('latin-1')
+                 for x in ('name', 'kind', 'lang')}
 
         entry['lang'] = self._ctags_to_vim(entry['lang'], languages)
 
@@ -557,17 +1476,14 @@ class Neotags(object):
             name = fgroup.sub('', name)
             kind = entry['lang'] + '#' + entry['kind'] + '_filter'
 
-        if kind in groups:
-            if name not in groups[kind]:
-                if self._check_tags(name):
-                    groups[kind].append(name)
-        else:
-            if self._check_tags(name):
-                groups[kind] = [name]
+        if not groups.has(kind, name) and check(name):
+            groups.add(kind, name)
 
-    def _check_tags(self, tag):
-        """Reject tags that do not appear in the current buffer."""
-        return (self.__slurp.find(tag) > 0) and tag not in self.__ignored_tags
+    def _tag_filter(self, slurp):
+        """Return a check rejecting tags that do not appear in slurp, the
+        text of a buffer."""
+        ignored = self.__ignored_tags
+        return lambda tag: slurp.find(tag) > 0 and tag not in ignored
 
 # =============================================================================
 
@@ -583,26 +1499,24 @@ class Neotags(object):
 
         return orderlist
 
-    def _run_ctags(self):
-        ctags_args = self.__vim.vars['neotags_ctags_args']
+    def _run_ctags(self, recurse, path, tagfile, incremental=False):
         self._debug_start()
+        File = None
 
-        recurse, path = self._get_file()
-        ctags_args.append('-f "%s"' % self.__tagfile)
-        ctags_binary = None
+        if incremental and recurse and self._can_update_shards(tagfile):
+            self._update_shards(path, tagfile)
+            self._debug_end("Finished running ctags")
+            return
+
+        if recurse and self._resume_index(path, tagfile):
+            self._debug_end("Finished running ctags")
+            return
 
         if recurse:
             if self.__find_tool:
-                ctags_args.append('-L-')
-                ctags_binary = "%s %s | %s" % (
-                    self.__find_tool, path, self.__vim.vars['neotags_ctags_bin']
-                )
                 self._debug_echo("Using %s to find files recursively in dir '%s'"
                                  % (self.__find_tool, path))
             else:
-                ctags_args.append('-R')
-                ctags_args.append('"%s"' % path)
-                ctags_binary = self.__vim.vars['neotags_ctags_bin']
                 self._debug_echo("Running ctags on dir '%s'" % path)
 
         else:
@@ -610,11 +1524,14 @@ class Neotags(object):
                 "Not running ctags recursively for dir '%s'" % path
             )
             File = os.path.realpath(self.__vim.api.eval("expand('%:p')"))
-            ctags_args.append('"%s"' % File)
-            ctags_binary = self.__vim.vars['neotags_ctags_bin']
             self._debug_echo("Running ctags on file '%s'" % File)
 
-        full_command = '%s %s' % (ctags_binary, ' '.join(ctags_args))
+        outfile = tagindex.temp_path(tagfile)
+        full_command = self._ctags_command(
+            outfile, path, recurse, File,
+            self.__vim.vars['neotags_ctags_args'],
+            self.__vim.vars['neotags_ctags_bin']
+        )
         self._debug_echo(full_command)
 
         try:
@@ -634,13 +1551,10 @@ class Neotags(object):
             self._debug_start()
 
             try:
-                with open(self.__tagfile, errors='replace') as src:
-                    with gzip.open(self.__tagfile + SUFFIX, 'wb', 9) as dst:
-                        dst.write(src.buffer.read())
+                with open(outfile, errors='replace') as src:
+                    self._store_index(src.buffer, tagfile, path)
                     src.seek(0)
-                    self.update_vim_tagfile(self.__tagfile + SUFFIX, src)
-
-                os.unlink(self.__tagfile)
+                    self.update_vim_tagfile(self._index_path(tagfile), src)
 
             except IOError as err:
                 self._error("Unexpected IO Error -> '%s'" % err)
@@ -656,13 +1570,283 @@ class Neotags(object):
             except ImportError:
                 proc.kill()
 
-            if self.__vim.vars['neotags_silent_timeout'] == 0:
-                self.__vim.command(
-                    "echom 'Ctags process timed out!'",
-                    async=True
-                )
+            self._ctags_timed_out(recurse, path, tagfile)
         finally:
+            try:
+                os.unlink(outfile)
+            except OSError:
+                pass
+            self._debug_end("Finished running ctags")
+
+    def _ctags_timed_out(self, recurse, path, tagfile):
+        message = 'Ctags process timed out!'
+        if recurse and self.__batch > 0:
+            self._start_batches(path, tagfile)
+            message = 'Ctags process timed out! Indexing in batches.'
+
+        if self.__vim.vars['neotags_silent_timeout'] == 0:
+            self.__vim.command("echom '%s'" % message, async=True)
+
+    def _stream_ctags(self, ft, token, recurse, path, tagfile,
+                      incremental=False):
+        """Run ctags with its output on a pipe. As the output arrives it is
+        written to the index and to vim's copy of the tags, and the tags for
+        ft are parsed into groups, with partial highlights sent every
+        STREAM_INTERVAL seconds. Returns the groups, or None if they have to
+        be read back from the index instead."""
+        self._debug_start()
+        File = None
+
+        if incremental and recurse and self._can_update_shards(tagfile):
+            self._debug_end("Updating shards instead of streaming")
+            self._run_ctags(recurse, path, tagfile, incremental=True)
+            return None
+        if recurse and self._resume_index(path, tagfile):
+            self._debug_end("Finished running ctags")
+            return None
+        if not recurse:
+            File = os.path.realpath(self.__vim.api.eval("expand('%:p')"))
+
+        # Sorting would hold back all of the output until ctags is done.
+        full_command = self._ctags_command(
+            '-', path, recurse, File,
+            self.__vim.vars['neotags_ctags_args'] + ['--sort=no'],
+            self.__vim.vars['neotags_ctags_bin']
+        )
+        self._debug_echo(full_command)
+
+        check = self._tag_filter(self._slurp(token))
+        languages = ft.lower().split('.')
+        pattern = self._tags_pattern(ft.lower().split('.'))
+        file = self.__vim.api.eval("expand('%:p:p')")
+        index = self._index_path(tagfile)
+        groups = TagGroups()
+
+        def consume(block):
+            writer.writelines(block.splitlines(True))
+            vimfile.write(block.decode('utf8', 'replace'))
+            for match in pattern.finditer(block):
+                self._parseLine(match, groups, languages, check)
+
+        try:
+            proc = subprocess.Popen(full_command, shell=True,
+                                    stdout=subprocess.PIPE,
+                                    stderr=subprocess.PIPE)
+        except OSError as error:
+            self._error('failed to run Ctags %s' % error)
             self._debug_end("Finished running ctags")
+            return None
+
+        chunks = queue.Queue()
+        errors = []
+        reader = threading.Thread(target=_read_pipe,
+                                  args=(proc.stdout, chunks))
+        reader.daemon = True
+        reader.start()
+        err_reader = threading.Thread(
+            target=lambda: errors.append(proc.stderr.read()))
+        err_reader.daemon = True
+        err_reader.start()
+
+        writer = self._index_writer(tagfile, path)
+        vimfile = self._open_vim_tagfile(index)
+        deadline = time.time() + self.__vim.vars['neotags_ctags_timeout']
+        shown = time.time()
+        rest = b''
+
+        while True:
+            try:
+                data = chunks.get(timeout=max(deadline - time.time(), 0))
+            except queue.Empty:
+                try:
+                    self._kill(proc.pid)
+                except ImportError:
+                    proc.kill()
+                writer.abort()
+
+                self._ctags_timed_out(recurse, path, tagfile)
+                self._debug_end("Finished running ctags")
+                return None
+
+            if not data:
+                break
+
+            data = rest + data
+            cut = data.rfind(b'\n') + 1
+            rest = data[cut:]
+            if cut:
+                consume(data[:cut])
+
+            if time.time() - shown >= STREAM_INTERVAL:
+                self._stream_highlight(ft, file, token, groups)
+                shown = time.time()
+
+        if rest:
+            consume(rest + b'\n')
+
+        proc.wait()
+        err_reader.join()
+        if errors and errors[0]:
+            self._error('Ctags completed with errors')
+            for e in errors[0].decode('ascii', 'replace').split('\n'):
+                self._error(e)
+        else:
+            self._debug_echo('Ctags completed successfully')
+
+        writer.close()
+        self._close_vim_tagfile(index)
+        self._debug_end("Finished streaming ctags")
+
+        return self._add_libraries(ft, token,
+                                   self._clean_groups(ft, groups, token),
+                                   check)
+
+    def _stream_highlight(self, ft, file, token, groups):
+        """Highlight the tags found so far. Once the buffer has changed this
+        stops, but the index is still completed."""
+        if token.cancelled:
+            return
+
+        try:
+            partial = self._clean_groups(ft, groups.copy(), token)
+            order = self._tags_order(ft) or partial.keys()
+            units = self._highlight_units(order, partial)
+            self._apply_units(token, ft, file, units, False, None)
+        except JobCancelled:
+            pass
+
+    def _ctags_command(self, tagfile, path, recurse, File, ctags_args,
+                       ctags_bin, listfile=None):
+        ctags_args.append('-f "%s"' % tagfile)
+
+        if recurse:
+            # Library directories inside a project have their own index.
+            for lib in self.__library_dirs:
+                if lib != path and os.path.commonpath([lib, path]) == path:
+                    ctags_args.append('--exclude="%s"' % lib)
+
+            if self.__find_tool:
+                ctags_args.append('-L-')
+                ctags_binary = "%s %s | %s" % (self.__find_tool, path,
+                                               ctags_bin)
+            else:
+                ctags_args.append('-R')
+                ctags_args.append('"%s"' % path)
+                ctags_binary = ctags_bin
+        elif listfile is not None:
+            ctags_args.append('-L "%s"' % listfile)
+            ctags_binary = ctags_bin
+        else:
+            ctags_args.append('"%s"' % File)
+            ctags_binary = ctags_bin
+
+        return '%s %s' % (ctags_binary, ' '.join(ctags_args))
+
+    def _index_path(self, tagfile):
+        """The file whose existence and mtime stand for the whole index."""
+        if self.__sharded:
+            return tagindex.manifest_path(tagfile)
+        return tagfile + SUFFIX
+
+    def _index_files(self, tagfile, ft):
+        """The compressed tag files of the project to read for the given
+        filetype. Library indexes are parsed apart (see _library_groups)."""
+        files = self._select_index(tagfile, ft)
+        if tagfile in self.__resumable:
+            # Until the last batch is done the index may not exist yet.
+            files = [File for File in files if os.path.exists(File)]
+            pending = tagindex.pending_path(tagfile)
+            if os.path.exists(pending):
+                files.append(pending)
+        return files
+
+    def _select_index(self, tagfile, ft):
+        if not self.__sharded:
+            return [tagfile + SUFFIX]
+        return tagindex.select_shards(tagfile, self._shard_languages(ft))
+
+    def _shard_languages(self, ft):
+        return [self.__vtoc.get(lang, lang).strip('\\')
+                for lang in ft.lower().split('.')]
+
+    def _all_index_files(self, tagfile):
+        if self.__sharded:
+            return tagindex.shard_files(tagfile)
+        return [tagfile + SUFFIX]
+
+    def _index_writer(self, tagfile, path, library=False):
+        if library:
+            return tagindex.ShardWriter(tagfile, path, False)
+        if self.__sharded:
+            return tagindex.ShardWriter(tagfile, path, self.__shard_by_dir)
+        return tagindex.IndexWriter(tagfile + SUFFIX)
+
+    def _store_index(self, src, tagfile, path, library=False):
+        """Compress the ctags output read from src into the index."""
+        writer = self._index_writer(tagfile, path, library)
+        if self.__sharded or library:
+            for line in src:
+                writer.write(line)
+        else:
+            writer.write(src.read())
+        writer.close()
+
+    def _can_update_shards(self, tagfile):
+        if not self.__sharded:
+            return False
+        manifest = tagindex.read_manifest(tagfile)
+        return (manifest is not None
+                and manifest['by_dir'] == bool(self.__shard_by_dir)
+                and os.path.exists(tagindex.files_path(tagfile)))
+
+    def _update_shards(self, path, tagfile):
+        """Re-tag only the current file and rewrite the shards holding it."""
+        File = os.path.realpath(self.__vim.api.eval("expand('%:p')"))
+        tmpfile = tagindex.temp_path(tagfile)
+        full_command = self._ctags_command(
+            tmpfile, path, False, File,
+            self.__vim.vars['neotags_ctags_args'],
+            self.__vim.vars['neotags_ctags_bin']
+        )
+        self._debug_echo(full_command)
+
+        try:
+            subprocess.call(full_command, shell=True,
+                            stderr=subprocess.DEVNULL,
+                            timeout=self.__vim.vars['neotags_ctags_timeout'])
+            with open(tmpfile, 'rb') as fp:
+                lines = fp.readlines()
+            os.unlink(tmpfile)
+        except (OSError, subprocess.TimeoutExpired) as err:
+            self._error('failed to run Ctags %s' % err)
+            return
+
+        touched = tagindex.update_file(tagfile, File, lines)
+        self._debug_echo("Rewrote shards: %s" % ', '.join(touched), False)
+
+    def _read_index(self, comp_file):
+        """Return the decompressed content of an index file. When prewarming
+        is enabled the result is kept in memory until the file changes or
+        another project is parsed (see _trim_index_cache)."""
+        mtime = os.path.getmtime(comp_file)
+        cached = self.__index_cache.get(comp_file)
+        if cached is not None and cached[0] == mtime:
+            return cached[1]
+
+        with gzip.open(comp_file, 'r') as fp:
+            data = fp.read()
+
+        if self.__prewarm:
+            self.__index_cache[comp_file] = (mtime, data)
+        return data
+
+    def _trim_index_cache(self, files):
+        """Drop the cached index files that the parse of files does not use,
+        so that only the current project stays in memory."""
+        if self.__index_cache:
+            self.__index_cache = {File: cached for File, cached
+                                  in list(self.__index_cache.items())
+                                  if File in files}
 
     def _exists(self, kind, var, default):
         Buffer = kind + var
@@ -721,12 +1905,17 @@ class Neotags(object):
 
         return None
 
+    def _timings(self):
+        """The timing stack of the running job. Jobs run in greenlets of
+        their own and interleave while waiting on nvim, so each needs one."""
+        return self.__start_time.setdefault(greenlet.getcurrent(), [])
+
     def _debug_start(self):
-        self.__start_time.append(time.time())
+        self._timings().append(time.time())
 
     def _debug_echo(self, message, pop=True):
         if pop:
-            elapsed = time.time() - self.__start_time[-1]
+            elapsed = time.time() - self._timings()[-1]
             self.__vim.command(
                 'echom "%s (%.2fs)"' %
                 (self.__to_escape.sub(r'\\\g<0>', message).replace('"', r'\"'),
@@ -737,7 +1926,7 @@ class Neotags(object):
 
     def _debug_end(self, message):
         self._debug_echo(message)
-        self.__start_time.pop()
+        self._timings().pop()
         # self._debug_echo("Total elapsed: " + str(time.time() - self.__globtime), False)
 
     def _inform_echo(self, message):
@@ -780,11 +1969,23 @@ class Neotags(object):
 
     def _get_file(self):
         File = os.path.realpath(self.__vim.api.eval("expand('%:p')"))
-        path = os.path.dirname(File)
-        projects = []
 
         self._debug_start()
 
+        recurse, path = self._project_for(File)
+        tagfile = self._tagfile_for(path if recurse else File)
+
+        self.__vim.command('let g:neotags_file = "%s"' % tagfile, async=True)
+        self._debug_end("File is '%s'" % tagfile)
+
+        return recurse, path, tagfile
+
+    def _project_for(self, File):
+        """Return whether File is tagged recursively, and the directory of
+        the project it belongs to."""
+        path = os.path.dirname(File)
+        projects = []
+
         recurse = (self.__vim.vars['neotags_recursive']
                    and path not in self.__noRecurseDirs)
 
@@ -803,18 +2004,10 @@ class Neotags(object):
                     break
 
             path = os.path.realpath(path)
-            self._path_replace(path)
-
-        else:
-            self._path_replace(File)
-
-        self.__vim.command('let g:neotags_file = "%s"'
-                           % self.__tagfile, async=True)
-        self._debug_end("File is '%s'" % self.__tagfile)
 
         return recurse, path
 
-    def _path_replace(self, path):
+    def _tagfile_for(self, path, directory=None):
         if (platform == 'win32'):
             # For some reason replace wouldn't work here. I have no idea why.
             path = re.sub(':', '__', path)
@@ -822,8 +2015,8 @@ class Neotags(object):
         else:
             sep_char = '/'
 
-        self.__tagfile = "%s/%s.tags" % (self.__directory,
-                                         path.replace(sep_char, '__'))
+        return "%s/%s.tags" % (directory or self.__directory,
+                               path.replace(sep_char, '__'))
 
     def _get_binary(self, loud=False):
         binary = self.__vim.vars['neotags_bin']
@@ -847,30 +2040,38 @@ class Neotags(object):
 
     def update_vim_tagfile(self, tagfile, open_file):
         try:
-            if tagfile not in self.__tmp_cache:
-                self.__tmp_cache[tagfile] = {}
-                fd, name = mkstemp()
-                tmpfile = os.fdopen(fd, errors='replace', mode='w')
+            tmpfile = self._open_vim_tagfile(tagfile)
+            self._write_file(open_file, tmpfile, tagfile)
+            self._close_vim_tagfile(tagfile)
 
-                self._write_file(open_file, tmpfile, tagfile)
+        except IOError as err:
+            self._error("something horrible happened -> %s" % err)
 
-                self.__tmp_cache[tagfile]['fp'] = tmpfile
-                self.__tmp_cache[tagfile]['name'] = name
+    def _open_vim_tagfile(self, tagfile):
+        """Return the (emptied) temporary copy of tagfile handed to vim."""
+        if tagfile not in self.__tmp_cache:
+            self.__tmp_cache[tagfile] = {}
+            fd, name = mkstemp()
+            tmpfile = os.fdopen(fd, errors='replace', mode='w')
 
-            else:
-                tmpfile = self.__tmp_cache[tagfile]['fp']
-                name = self.__tmp_cache[tagfile]['name']
-                tmpfile.seek(0)
-                tmpfile.truncate(0)
-                tmpfile.flush()
-                self._write_file(open_file, tmpfile, tagfile)
+            self.__tmp_cache[tagfile]['fp'] = tmpfile
+            self.__tmp_cache[tagfile]['name'] = name
 
+        else:
+            tmpfile = self.__tmp_cache[tagfile]['fp']
+            tmpfile.seek(0)
+            tmpfile.truncate(0)
             tmpfile.flush()
-            self.__tmp_cache[tagfile]['mtime'] = os.path.getmtime(tagfile)
-            self.__vim.command('set tags+=%s' % name, async=True)
 
-        except IOError as err:
-            self._error("something horrible happened -> %s" % err)
+        return tmpfile
+
+    def _close_vim_tagfile(self, tagfile):
+        tmpfile = self.__tmp_cache[tagfile]['fp']
+        name = self.__tmp_cache[tagfile]['name']
+
+        tmpfile.flush()
+        self.__tmp_cache[tagfile]['mtime'] = os.path.getmtime(tagfile)
+        self.__vim.command('set tags+=%s' % name, async=True)
 
     def _write_file(self, File, tmp, name):
         tmp.write(File.read())
@@ -0,0 +1,175 @@
+# ============================================================================
+# File:        taggroups.py
+# Author:      Christian Persson <c0r73x@gmail.com>
+# Repository:  https://github.com/c0r73x/neotags.nvim
+#              Released under the MIT license
+# ============================================================================
+# Compact storage for the tag groups of a filetype. Every distinct name is
+# stored once, utf8 encoded, in one bytearray; a group is an array of indexes
+# into it. Highlight commands are joined straight from the stored bytes.
+import sys
+from array import array
+
+ENCODING = 'utf8'
+
+
+class TagTable(object):
+    """Interned tag names, stored back to back in a single blob. Name i is
+    blob[offsets[i]:offsets[i + 1]]."""
+
+    def __init__(self):
+        self.blob = bytearray()
+        self.offsets = array('I', [0])
+        self.__ids = {}
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def lookup(self, name):
+        return self.__ids.get(name)
+
+    def intern(self, name):
+        ident = self.__ids.get(name)
+        if ident is None:
+            ident = self.__ids[name] = len(self.offsets) - 1
+            self.blob += name.encode(ENCODING, 'surrogateescape')
+            self.offsets.append(len(self.blob))
+        return ident
+
+    def name(self, ident):
+        return self.join((ident,), '')
+
+    def join(self, ids, sep):
+        blob, offsets = self.blob, self.offsets
+        return sep.encode(ENCODING).join(
+            blob[offsets[i]:offsets[i + 1]] for i in ids
+        ).decode(ENCODING, 'surrogateescape')
+
+    def freeze(self):
+        """Drop the lookup dict once no more names will be added."""
+        self.__ids = {}
+
+    def size(self):
+        return sys.getsizeof(self.blob) + sys.getsizeof(self.offsets)
+
+
+class TagList(object):
+    """One group of tags, in the order they were found."""
+    __slots__ = ('table', 'ids')
+
+    def __init__(self, table, ids=None):
+        self.table = table
+        self.ids = array('I') if ids is None else ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __iter__(self):
+        for ident in self.ids:
+            yield self.table.name(ident)
+
+    def join(self, sep, start=0, stop=None):
+        return self.table.join(self.ids[start:stop], sep)
+
+    def digest(self):
+        import hashlib
+        data = self.join('\n').encode(ENCODING, 'surrogateescape')
+        return hashlib.md5(data).hexdigest()
+
+    def select(self, keep):
+        """A copy of this group with only the tags for which keep is true."""
+        name = self.table.name
+        return TagList(self.table,
+                       array('I', (i for i in self.ids if keep(name(i)))))
+
+    def without(self, other):
+        """A copy of this group without the tags that are in other."""
+        drop = set(other.ids)
+        return TagList(self.table,
+                       array('I', (i for i in self.ids if i not in drop)))
+
+
+class TagGroups(object):
+    """Maps group keys such as 'c#f' to TagLists sharing one TagTable."""
+
+    def __init__(self, table=None):
+        self.table = TagTable() if table is None else table
+        self.__groups = {}
+        self.__members = {}
+
+    def __contains__(self, key):
+        return key in self.__groups
+
+    def __getitem__(self, key):
+        return self.__groups[key]
+
+    def __setitem__(self, key, group):
+        self.__groups[key] = group
+        self.__members.pop(key, None)
+
+    def keys(self):
+        return self.__groups.keys()
+
+    def values(self):
+        return self.__groups.values()
+
+    def items(self):
+        return self.__groups.items()
+
+    def ensure(self, key):
+        if key not in self.__groups:
+            self.__groups[key] = TagList(self.table)
+        return self.__groups[key]
+
+    def has(self, key, name):
+        ident = self.table.lookup(name)
+        if ident is None or key not in self.__groups:
+            return False
+        return ident in self._members(key)
+
+    def add(self, key, name):
+        """Add name to a group unless it is already in it."""
+        ident = self.table.intern(name)
+        group = self.ensure(key)
+        members = self._members(key)
+        if ident not in members:
+            members.add(ident)
+            group.ids.append(ident)
+
+    def _members(self, key):
+        members = self.__members.get(key)
+        if members is None:
+            members = self.__members[key] = set(self.__groups[key].ids)
+        return members
+
+    def copy(self):
+        groups = TagGroups(self.table)
+        for key, group in self.__groups.items():
+            groups[key] = group
+        return groups
+
+    def select(self, keep):
+        """A copy with every group filtered by keep. Groups left empty are
+        kept, so that their highlights are cleared."""
+        groups = TagGroups(self.table)
+        for key, group in self.__groups.items():
+            groups[key] = group.select(keep)
+        return groups
+
+    def freeze(self):
+        self.__members = {}
+        self.table.freeze()
+
+    def count(self):
+        return sum(len(group) for group in self.__groups.values())
+
+    def size(self):
+        """Approximate memory used, in bytes."""
+        return self.table.size() + sum(sys.getsizeof(group.ids)
+                                       for group in self.__groups.values())
+
+    def usage(self):
+        count = self.count()
+        size = self.size()
+        return '%d tags, %d bytes (%.1f bytes/tag)' % (
+            count, size, float(size) / count if count else 0.0)
@@ -0,0 +1,438 @@
+# ============================================================================
+# File:        tagindex.py
+# Author:      Christian Persson <c0r73x@gmail.com>
+# Repository:  https://github.com/c0r73x/neotags.nvim
+#              Released under the MIT license
+# ============================================================================
+# Sharded tag indexes. Instead of one <tagfile>.gz per project, the tags are
+# split by ctags language (and optionally by top level directory) into
+# <tagfile>.d/<shard>.tags.gz, described by <tagfile>.d/manifest.json.
+# <tagfile>.d/files.json lists the shards that hold the tags of each file,
+# so that re-tagging one file only has to rewrite those.
+#
+# gzip is imported where it is used so that importing this module stays
+# cheap (see _load_modules() in neotags.py).
+import json
+import os
+import re
+
+MANIFEST = 'manifest.json'
+FILES = 'files.json'
+SUFFIX = '.gz'
+HEADER = b'!_TAG_'
+
+_UNSAFE = re.compile(r'[^\w.-]')
+
+
+def shard_directory(tagfile):
+    return tagfile + '.d'
+
+
+def manifest_path(tagfile):
+    return os.path.join(shard_directory(tagfile), MANIFEST)
+
+
+def read_manifest(tagfile):
+    try:
+        with open(manifest_path(tagfile), 'r') as fp:
+            return json.load(fp)
+    except (IOError, ValueError):
+        return None
+
+
+def files_path(tagfile):
+    return os.path.join(shard_directory(tagfile), FILES)
+
+
+def read_files(tagfile):
+    """Return the mapping of tagged file to the names of its shards, or
+    None if the index has none."""
+    try:
+        with open(files_path(tagfile), 'r') as fp:
+            return json.load(fp)
+    except (IOError, ValueError):
+        return None
+
+
+def shard_name(lang, topdir):
+    def quote(string):
+        return _UNSAFE.sub(lambda m: '%%%02X' % ord(m.group(0)), string)
+
+    name = quote(lang or 'unknown')
+    if topdir:
+        name += '@' + quote(topdir)
+    return name + '.tags' + SUFFIX
+
+
+def shard_files(tagfile):
+    """Return the paths of every shard of an index."""
+    manifest = read_manifest(tagfile)
+    if manifest is None:
+        return []
+
+    directory = shard_directory(tagfile)
+    return [os.path.join(directory, name)
+            for name in sorted(manifest['shards'])]
+
+
+def select_shards(tagfile, languages):
+    """Return the paths of the shards holding tags for any of the given
+    ctags languages. C and C++ are treated as one language, as they are by
+    the tag engines."""
+    manifest = read_manifest(tagfile)
+    if manifest is None:
+        return []
+
+    wanted = set(lang.lower() for lang in languages)
+    if 'c' in wanted or 'c++' in wanted:
+        wanted.update(('c', 'c++'))
+
+    directory = shard_directory(tagfile)
+    return [os.path.join(directory, name)
+            for name, shard in sorted(manifest['shards'].items())
+            if shard['lang'].lower() in wanted]
+
+
+def _line_info(line):
+    """Return the (file, language) fields of a tags line."""
+    fields = line.rstrip(b'\r\n').split(b'\t')
+    lang = b''
+    for field in reversed(fields[3:]):
+        if field.startswith(b'language:'):
+            lang = field[9:]
+            break
+
+    filename = fields[1] if len(fields) > 1 else b''
+    return filename, lang.decode('utf8', 'replace')
+
+
+def _topdir(filename, root):
+    if isinstance(filename, bytes):
+        filename = filename.decode('utf8', 'replace')
+    rel = os.path.relpath(filename, root).split(os.sep, 1)
+    if len(rel) == 1 or rel[0] == '..':
+        return ''
+    return rel[0]
+
+
+def temp_path(path):
+    """Create an empty file next to path, to be moved over it once written.
+    The prewarm and library threads and the jobs on the main loop may write
+    the same file at once, so every writer gets a file of its own."""
+    from tempfile import mkstemp
+    fd, name = mkstemp(dir=os.path.dirname(path),
+                       prefix=os.path.basename(path) + '.', suffix='.tmp')
+    os.close(fd)
+    return name
+
+
+def _write_manifest(tagfile, root, by_dir, shards):
+    path = manifest_path(tagfile)
+    tmp = temp_path(path)
+    with open(tmp, 'w') as fp:
+        json.dump({'root': root, 'by_dir': by_dir, 'shards': shards}, fp)
+    os.replace(tmp, path)
+
+
+def _write_files(tagfile, files):
+    path = files_path(tagfile)
+    tmp = temp_path(path)
+    with open(tmp, 'w') as fp:
+        json.dump(files, fp)
+    os.replace(tmp, path)
+
+
+def _write_shard(path, lines):
+    import gzip
+    tmp = temp_path(path)
+    with gzip.open(tmp, 'wb', 9) as fp:
+        fp.writelines(lines)
+    os.replace(tmp, path)
+
+
+class IndexWriter(object):
+    """Writes an unsharded index, with the same interface as ShardWriter."""
+
+    def __init__(self, path):
+        import gzip
+        self.path = path
+        self.__tmp = temp_path(path)
+        self.__fp = gzip.open(self.__tmp, 'wb', 9)
+
+    def write(self, line):
+        self.__fp.write(line)
+
+    def writelines(self, lines):
+        self.__fp.writelines(lines)
+
+    def close(self):
+        self.__fp.close()
+        os.replace(self.__tmp, self.path)
+
+    def abort(self):
+        self.__fp.close()
+        os.unlink(self.__tmp)
+
+
+class ShardWriter(object):
+    """Distributes the lines of a tags file over the shards of an index.
+
+    Lines are routed by their language field and, if by_dir is set, by the
+    top level directory of the tagged file relative to root. Shards are
+    written to temporary files which close() moves into place together
+    with the new manifest."""
+
+    def __init__(self, tagfile, root, by_dir):
+        self.tagfile = tagfile
+        self.root = root
+        self.by_dir = bool(by_dir)
+        self.directory = shard_directory(tagfile)
+        self.header = []
+        self.shards = {}
+        self.located = {}
+        self.__files = {}
+        self.__temps = {}
+
+        if not os.path.isdir(self.directory):
+            os.mkdir(self.directory)
+
+    def write(self, line):
+        if line.startswith(HEADER):
+            self.header.append(line)
+            return
+        if not line.endswith(b'\n'):
+            line += b'\n'
+
+        filename, lang = _line_info(line)
+        topdir = _topdir(filename, self.root) if self.by_dir else ''
+        name = shard_name(lang, topdir)
+
+        fp = self.__files.get(name)
+        if fp is None:
+            fp = self._open(name, lang, topdir)
+        fp.write(line)
+        self.shards[name]['tags'] += 1
+        self.located.setdefault(filename, set()).add(name)
+
+    def writelines(self, lines):
+        for line in lines:
+            self.write(line)
+
+    def _open(self, name, lang, topdir):
+        import gzip
+        tmp = self.__temps[name] = temp_path(os.path.join(self.directory,
+                                                          name))
+        fp = gzip.open(tmp, 'wb', 9)
+        fp.writelines(self.header)
+        self.__files[name] = fp
+        self.shards[name] = {'lang': lang, 'dir': topdir, 'tags': 0}
+        return fp
+
+    def close(self):
+        for name, fp in self.__files.items():
+            fp.close()
+            os.replace(self.__temps[name], os.path.join(self.directory, name))
+
+        _write_files(self.tagfile, {
+            filename.decode('utf8', 'surrogateescape'): sorted(names)
+            for filename, names in self.located.items()
+        })
+        old = read_manifest(self.tagfile)
+        _write_manifest(self.tagfile, self.root, self.by_dir, self.shards)
+
+        if old is not None:
+            for name in old['shards']:
+                if name not in self.shards:
+                    try:
+                        os.unlink(os.path.join(self.directory, name))
+                    except OSError:
+                        pass
+
+    def abort(self):
+        """Throw away everything written, leaving the old index in place."""
+        for name, fp in self.__files.items():
+            fp.close()
+            os.unlink(self.__temps[name])
+
+
+def update_file(tagfile, filename, lines):
+    """Replace the tags of one file with the given lines of fresh ctags
+    output. Only the shards that held or receive tags for that file are
+    rewritten; their names are returned."""
+    import gzip
+    manifest = read_manifest(tagfile)
+    files = read_files(tagfile)
+    root, by_dir = manifest['root'], manifest['by_dir']
+    shards = manifest['shards']
+    directory = shard_directory(tagfile)
+    key = filename.encode('utf8')
+    header = [line for line in lines if line.startswith(HEADER)]
+    topdir = _topdir(filename, root) if by_dir else ''
+
+    incoming = {}
+    for line in lines:
+        if line.startswith(HEADER):
+            continue
+        lang = _line_info(line)[1]
+        name = shard_name(lang, topdir)
+        incoming.setdefault(name, (lang, topdir, []))[2].append(line)
+
+    # One file can have tags in several languages, such as the JavaScript
+    # of a <script> block in HTML, and may have lost some of them. Without
+    # a record of its shards its old tags can be in any shard of its
+    # directory.
+    candidates = set(incoming)
+    if files is not None:
+        candidates.update(files.get(filename, ()))
+    else:
+        candidates.update(name for name, shard in shards.items()
+                          if shard['dir'] == topdir)
+
+    touched = []
+    for name in sorted(candidates):
+        path = os.path.join(directory, name)
+        old = []
+        if name in shards and os.path.exists(path):
+            with gzip.open(path, 'rb') as fp:
+                old = fp.readlines()
+
+        kept = [line for line in old
+                if line.startswith(HEADER) or _line_info(line)[0] != key]
+        new = incoming[name][2] if name in incoming else []
+        if not new and len(kept) == len(old):
+            continue
+
+        head = [line for line in kept if line.startswith(HEADER)] or header
+        body = [line for line in kept if not line.startswith(HEADER)] + new
+        body.sort()
+        _write_shard(path, head + body)
+
+        if name in incoming:
+            lang, topdir = incoming[name][:2]
+        else:
+            lang, topdir = shards[name]['lang'], shards[name]['dir']
+        shards[name] = {'lang': lang, 'dir': topdir, 'tags': len(body)}
+        touched.append(name)
+
+    if files is not None and sorted(incoming) != files.get(filename, []):
+        if incoming:
+            files[filename] = sorted(incoming)
+        else:
+            files.pop(filename, None)
+        _write_files(tagfile, files)
+    if touched:
+        _write_manifest(tagfile, root, by_dir, shards)
+    return touched
+
+
+# Checkpointed indexing. When ctags -R runs past its timeout the project is
+# indexed in batches of files instead. The files still to do are listed in
+# <tagfile>.pending.files and the progress is kept in <tagfile>.pending.json.
+# Every finished batch is appended to <tagfile>.pending.gz as a gzip member
+# of its own, which is read together with the index until the last batch is
+# done and the whole is sorted into the index proper.
+
+SORTED = b'!_TAG_FILE_SORTED\t'
+
+
+def pending_path(tagfile):
+    return tagfile + '.pending' + SUFFIX
+
+
+def _checkpoint_path(tagfile):
+    return tagfile + '.pending.json'
+
+
+def _filelist_path(tagfile):
+    return tagfile + '.pending.files'
+
+
+def checkpointed(directory):
+    """Return the tag files in directory that have a checkpoint."""
+    suffix = _checkpoint_path('')
+    try:
+        names = os.listdir(directory)
+    except OSError:
+        return []
+    return [os.path.join(directory, name[:-len(suffix)])
+            for name in names if name.endswith(suffix)]
+
+
+def read_checkpoint(tagfile):
+    try:
+        with open(_checkpoint_path(tagfile), 'r') as fp:
+            return json.load(fp)
+    except (IOError, ValueError):
+        return None
+
+
+def write_checkpoint(tagfile, checkpoint):
+    path = _checkpoint_path(tagfile)
+    with open(path + '.tmp', 'w') as fp:
+        json.dump(checkpoint, fp)
+    os.replace(path + '.tmp', path)
+
+
+def start_checkpoint(tagfile, root, files, batch):
+    """Begin indexing the given files of root in batches of batch files,
+    throwing away any earlier checkpoint. Returns the new checkpoint."""
+    clear_checkpoint(tagfile)
+    path = _filelist_path(tagfile)
+    with open(path + '.tmp', 'w', errors='surrogateescape') as fp:
+        fp.writelines(name + '\n' for name in files)
+    os.replace(path + '.tmp', path)
+
+    checkpoint = {'root': root, 'total': len(files), 'done': 0,
+                  'batch': batch, 'batches': 0, 'size': 0, 'skipped': []}
+    write_checkpoint(tagfile, checkpoint)
+    return checkpoint
+
+
+def read_filelist(tagfile):
+    with open(_filelist_path(tagfile), 'r', errors='surrogateescape') as fp:
+        return fp.read().splitlines()
+
+
+def append_pending(tagfile, checkpoint, data):
+    """Append one batch of ctags output as a new gzip member. The file is
+    first cut back to the size recorded in the checkpoint, which drops the
+    remains of a batch that was interrupted before the checkpoint was
+    written. Only the first batch keeps its pseudo tags."""
+    import gzip
+    if checkpoint['size']:
+        data = b''.join(line for line in data.splitlines(True)
+                        if not line.startswith(HEADER))
+
+    path = pending_path(tagfile)
+    with open(path, 'r+b' if os.path.exists(path) else 'w+b') as fp:
+        # Never seek past the end: truncating there would pad the file with
+        # zero bytes, and gzip readers stop at those.
+        fp.seek(min(checkpoint['size'], os.fstat(fp.fileno()).st_size))
+        fp.truncate()
+        fp.write(gzip.compress(data, 9))
+        checkpoint['size'] = fp.tell()
+
+
+def finish_pending(tagfile):
+    """Return the tags of all batches sorted as ctags --sort=yes would, with
+    any batch that ran twice counted once."""
+    import gzip
+    with gzip.open(pending_path(tagfile), 'rb') as fp:
+        lines = set(line.rstrip(b'\n') + b'\n' for line in fp)
+
+    out = []
+    for line in sorted(lines):
+        if line.startswith(SORTED):
+            # The batches themselves were written unsorted.
+            line = SORTED + b'1' + line[len(SORTED) + 1:]
+        out.append(line)
+    return b''.join(out)
+
+
+def clear_checkpoint(tagfile):
+    for path in (_checkpoint_path(tagfile), _filelist_path(tagfile),
+                 pending_path(tagfile)):
+        try:
+            os.unlink(path)
+        except OSError:
+            pass
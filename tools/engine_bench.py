@@ -0,0 +1,443 @@
+#!/usr/bin/env python3
+# ============================================================================
+# File:        engine_bench.py
+# Author:      Christian Persson <c0r73x@gmail.com>
+# Repository:  https://github.com/c0r73x/neotags.nvim
+#              Released under the MIT license
+# ============================================================================
+# Runs the python tag engine (Neotags._getTags) and the C binary
+# (Neotags._bin_getTags) on the same generated tag files and buffers, and
+# reports tags per second, peak memory, the cost of spawning the binary and
+# every difference between the groups the two produce. Finally it recommends
+# a value for g:neotags_binary_threshold.
+#
+# Each measurement runs in a fresh interpreter so that peak RSS is per engine.
+# The engines are driven through the plugin's own code with a small stand-in
+# for the nvim API; the neovim python module must be importable.
+#
+#   python3 tools/engine_bench.py --bin ~/.vim_tags/bin/neotags
+import argparse
+import gzip
+import json
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from sys import platform
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RPLUGIN = os.path.join(ROOT, 'rplugin', 'python3')
+
+LANGUAGES = {'c': 'C', 'cpp': 'C++', 'python': 'Python', 'ruby': 'Ruby',
+             'java': 'Java', 'javascript': 'JavaScript', 'sh': 'Sh'}
+HEADER = (b'!_TAG_FILE_FORMAT\t2\t/extended format/\n'
+          b'!_TAG_FILE_SORTED\t1\t/0=unsorted, 1=sorted, 2=foldcase/\n')
+
+# =============================================================================
+# Reading plugin settings from the vim scripts
+
+
+def _vim_string(string):
+    if string[0] == "'":
+        return string[1:-1].replace("''", "'")
+    return string[1:-1].replace('\\"', '"').replace('\\\\', '\\')
+
+
+_STRING = r"""'(?:[^']|'')*'|"(?:[^"\\]|\\.)*\""""
+_LET = re.compile(r'^\s*let\s+(?:g:)?([\w#]+)\s*=\s*(.*)$')
+_ITEM = re.compile(r'(%s)\s*:\s*(%s)' % (_STRING, _STRING))
+
+
+def _vim_value(expr, variables):
+    """Evaluate the literals used by the plugin's settings. Returns None for
+    anything else."""
+    expr = expr.strip()
+    if re.match(r'^-?\d+$', expr):
+        return int(expr)
+    if re.match(r'^(%s)$' % _STRING, expr):
+        return _vim_string(expr)
+    if expr.startswith('['):
+        items = re.findall(_STRING, expr)
+        rest = re.sub(_STRING, '', expr)
+        if re.sub(r'[\s,\[\]]', '', rest):
+            return None
+        return [_vim_string(item) for item in items]
+    if expr.startswith('{'):
+        return {_vim_string(k): _vim_string(v)
+                for k, v in _ITEM.findall(expr)}
+    name = re.sub(r'^g:', '', expr)
+    if name in variables:
+        return variables[name]
+    return None
+
+
+def read_vim_settings(path, variables):
+    """Collect the `let g:...` assignments of a vim script."""
+    with open(path, 'r') as fp:
+        text = re.sub(r'\n\s*\\', ' ', fp.read())
+
+    for line in text.split('\n'):
+        match = _LET.match(line)
+        if match is None:
+            continue
+        value = _vim_value(match.group(2), variables)
+        if value is not None:
+            variables[match.group(1)] = value
+    return variables
+
+
+def plugin_settings(ft, binary, directory):
+    variables = read_vim_settings(os.path.join(ROOT, 'plugin', 'neotags.vim'),
+                                  {})
+    script = os.path.join(ROOT, 'plugin', 'neotags', ft + '.vim')
+    if os.path.exists(script):
+        read_vim_settings(script, variables)
+
+    variables.update({
+        'loaded_neotags': 0,
+        'neotags_enabled': 0,
+        'neotags_verbose': 0,
+        'neotags_startup_prewarm': 0,
+        'neotags_sharded': 0,
+        'neotags_directory': directory,
+        'neotags_settings_file': os.path.join(directory, 'neotags.txt'),
+        'neotags_norecurse_dirs': [],
+        'neotags_bin': binary or '',
+    })
+    return variables
+
+# =============================================================================
+# Stand-in for the parts of the nvim API used by the engines
+
+
+class _Current(object):
+
+    def __init__(self, lines):
+        self.buffer = lines
+
+
+class _Api(object):
+
+    def __init__(self, vim):
+        self.__vim = vim
+
+    def eval(self, expr):
+        from neotags.jobs import STATE_EXPR
+        from neovim.api.nvim import NvimError
+
+        if expr == STATE_EXPR:
+            return [1, 0, self.__vim.filetype]
+        if expr == '&ft':
+            return self.__vim.filetype
+        if expr.startswith('expand('):
+            return ''
+
+        value = self.__vim.lookup(expr)
+        if value is None:
+            raise NvimError('E121: Undefined variable: %s' % expr)
+        return value
+
+
+class _Funcs(object):
+
+    def __init__(self, vim):
+        self.__vim = vim
+
+    def exists(self, name):
+        return int(self.__vim.lookup(name) is not None)
+
+
+class BenchVim(object):
+
+    def __init__(self, variables, lines, filetype):
+        self.vars = variables
+        self.filetype = filetype
+        self.current = _Current(lines)
+        self.api = _Api(self)
+        self.funcs = _Funcs(self)
+        self.commands = []
+
+    def lookup(self, expr):
+        name, _, key = re.sub(r'^g:', '', expr).partition('.')
+        value = self.vars.get(name)
+        if key:
+            value = value.get(key) if isinstance(value, dict) else None
+        return value
+
+    def command(self, cmd, **kwargs):
+        self.commands.append(cmd)
+
+    def async_call(self, func, *args):
+        func(*args)
+
+# =============================================================================
+# Corpora
+
+
+def _identifier(rand, used):
+    while True:
+        name = ''.join(rand.choice('abcdefghijklmnopqrstuvwxyz_')
+                       for _ in range(rand.randint(4, 14)))
+        name += rand.choice(('', '', str(rand.randint(0, 99)), '_t', 'Impl'))
+        if name not in used and not name[0] == '_':
+            used.add(name)
+            return name
+
+
+def make_corpus(path, ntags, lang, order, hit_ratio, nlines, seed):
+    """Write a sorted, gzipped tags file with ntags entries and return the
+    lines of a buffer that uses roughly hit_ratio of them."""
+    rand = random.Random(seed)
+    used = set()
+    tags = []
+    for i in range(ntags):
+        kind = rand.choice(order)
+        name = _identifier(rand, used)
+        # Names the python engine drops through the 'ignore' settings.
+        if i % 50 == 0:
+            name = rand.choice(('__anon%x' % i, 'Outer::' + name))
+        tags.append((name, 'src/file%d.c' % rand.randint(0, ntags // 40 + 1),
+                     kind))
+
+    lines = [('%s\t%s\t/^%s$/;"\t%s\tlanguage:%s\n'
+              % (name, File, name, kind, lang)).encode('utf8')
+             for name, File, kind in sorted(tags)]
+    with gzip.open(path, 'wb', 9) as fp:
+        fp.write(HEADER)
+        fp.writelines(lines)
+
+    hits = [tag[0] for tag in tags if rand.random() < hit_ratio]
+    words = ['if', 'return', 'int', 'while', 'x', 'y', 'count', '0', '1']
+    buf = []
+    for _ in range(nlines):
+        line = [rand.choice(words) for _ in range(rand.randint(2, 8))]
+        if hits:
+            line.insert(rand.randint(0, len(line)), rand.choice(hits))
+        buf.append('    ' + ' '.join(line) + ';')
+    return buf
+
+# =============================================================================
+# Worker: runs one engine in this process and prints the results as JSON
+
+
+def _maxrss(children=False):
+    try:
+        import resource
+    except ImportError:
+        return None
+    who = resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF
+    rss = resource.getrusage(who).ru_maxrss
+    # Kilobytes on Linux and the BSDs, bytes on macOS.
+    return rss if platform == 'darwin' else rss * 1024
+
+
+def worker(args):
+    sys.path.insert(0, RPLUGIN)
+    from neotags import neotags as engines
+    from neotags.jobs import CancelToken
+
+    with open(args.buffer, 'r') as fp:
+        lines = fp.read().split('\n')
+
+    variables = plugin_settings(args.ft, args.bin,
+                                os.path.dirname(args.index))
+    vim = BenchVim(variables, lines, args.ft)
+    tagger = engines.Neotags(vim)
+    tagger.init()
+    engines._load_modules()
+
+    token = CancelToken(1, 0, args.ft)
+    # On Linux a child starts out with the RSS of the process that forked it,
+    # so the binary can not be measured below what this process uses.
+    floor = _maxrss()
+    times = []
+    groups = {}
+    for _ in range(args.repeat):
+        start = time.time()
+        groups = tagger._run_engine(args.engine, [args.index], args.ft, token)
+        times.append(time.time() - start)
+
+    if args.engine == 'binary':
+        rss = _maxrss(children=True)
+    else:
+        rss, floor = _maxrss(), 0
+
+    json.dump({'times': times, 'rss': rss, 'floor': floor,
+               'groups': {k: sorted(v) for k, v in (groups or {}).items()}},
+              sys.stdout)
+
+
+def run_worker(engine, index, buf, ft, binary, repeat):
+    cmd = [sys.executable, os.path.abspath(__file__), '--worker', engine,
+           '--index', index, '--buffer', buf, '--ft', ft,
+           '--repeat', str(repeat)]
+    if binary:
+        cmd += ['--bin', binary]
+
+    proc = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    if proc.returncode != 0:
+        sys.exit('%s engine failed:\n%s' % (engine, proc.stderr.decode()))
+    return json.loads(proc.stdout.decode())
+
+# =============================================================================
+# Reporting
+
+
+def _median(values):
+    values = sorted(values)
+    return values[len(values) // 2]
+
+
+def _size(num):
+    for unit in ('B', 'K', 'M'):
+        if abs(num) < 1024:
+            return '%d%s' % (num, unit)
+        num /= 1024.0
+    return '%.1fG' % num
+
+
+def _rss(res):
+    if res['rss'] is None:
+        return '-'
+    if res['floor'] and res['rss'] <= res['floor']:
+        return '<=' + _size(res['floor'])
+    return _size(res['rss'])
+
+
+def diff_groups(python, binary):
+    """Return (group, only in python, only in binary) for every group the
+    engines disagree on."""
+    diffs = []
+    for key in sorted(set(python) | set(binary)):
+        a = set(python.get(key, []))
+        b = set(binary.get(key, []))
+        if a != b:
+            diffs.append((key, sorted(a - b), sorted(b - a)))
+    return diffs
+
+
+def recommend(rows):
+    """Interpolate the index size at which the binary starts to win. rows is
+    a list of (index bytes, python seconds, binary seconds) sorted by size."""
+    gains = [(size, py - c) for size, py, c in rows]
+    if all(gain > 0 for _, gain in gains):
+        return 0
+    if all(gain <= 0 for _, gain in gains):
+        return None
+
+    # The last size at which python still wins, and the next one.
+    last = max(i for i, (_, gain) in enumerate(gains) if gain <= 0)
+    if last == len(gains) - 1:
+        return None
+    (x0, d0), (x1, d1) = gains[last], gains[last + 1]
+    return int(x0 + (x1 - x0) * (-d0) / float(d1 - d0))
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Compare the python and C tag engines of neotags.')
+    parser.add_argument('--bin', default=os.path.expanduser(
+        '~/.vim_tags/bin/neotags'), help='path to the neotags binary')
+    parser.add_argument('--ft', default='c', help='filetype to test')
+    parser.add_argument('--sizes', default='1000,10000,50000,200000',
+                        help='comma separated number of tags per corpus')
+    parser.add_argument('--lines', type=int, default=2000,
+                        help='number of lines in the buffer')
+    parser.add_argument('--hits', type=float, default=0.05,
+                        help='fraction of the tags used in the buffer')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--worker', choices=('python', 'binary'),
+                        help=argparse.SUPPRESS)
+    parser.add_argument('--index', help=argparse.SUPPRESS)
+    parser.add_argument('--buffer', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.worker:
+        args.engine = args.worker
+        return worker(args)
+
+    binary = args.bin if args.bin and os.path.exists(args.bin) else None
+    if binary is None:
+        print("Binary '%s' doesn't exist, measuring the python engine only."
+              % args.bin)
+
+    workdir = tempfile.mkdtemp(prefix='neotags-bench-')
+    try:
+        bench(args, binary, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+def bench(args, binary, workdir):
+    settings = plugin_settings(args.ft, None, workdir)
+    order = settings.get('neotags#%s#order' % args.ft)
+    if not order:
+        sys.exit("No neotags#%s#order setting found." % args.ft)
+    lang = LANGUAGES.get(args.ft, args.ft.capitalize())
+    engines = ['python'] + (['binary'] if binary else [])
+
+    def corpus(name, ntags, nlines):
+        index = os.path.join(workdir, name + '.tags.gz')
+        buf = os.path.join(workdir, name + '.buf')
+        lines = make_corpus(index, ntags, lang, order, args.hits, nlines,
+                            args.seed)
+        with open(buf, 'w') as fp:
+            fp.write('\n'.join(lines))
+        return index, buf
+
+    if binary:
+        index, buf = corpus('spawn', 1, 0)
+        spawn = _median(run_worker('binary', index, buf, args.ft, binary,
+                                   args.repeat * 4)['times'])
+        print('Spawn overhead of the binary: %.2fms per index file\n'
+              % (spawn * 1000))
+
+    print('Peak RSS of the python engine includes the interpreter.\n')
+    print('%8s %8s  %-7s %10s %12s %9s %7s'
+          % ('tags', 'index', 'engine', 'time', 'tags/s', 'peak RSS',
+             'groups'))
+    rows = []
+    for ntags in [int(n) for n in args.sizes.split(',')]:
+        index, buf = corpus('tags%d' % ntags, ntags, args.lines)
+        size = os.path.getsize(index)
+        results = {}
+        for engine in engines:
+            res = results[engine] = run_worker(engine, index, buf, args.ft,
+                                               binary, args.repeat)
+            elapsed = _median(res['times'])
+            print('%8d %8s  %-7s %9.1fms %12d %9s %7d'
+                  % (ntags, _size(size), engine, elapsed * 1000,
+                     ntags / max(elapsed, 1e-9), _rss(res),
+                     sum(len(v) for v in res['groups'].values())))
+
+        if binary:
+            rows.append((size, _median(results['python']['times']),
+                         _median(results['binary']['times'])))
+            for key, py_only, bin_only in diff_groups(
+                    results['python']['groups'], results['binary']['groups']):
+                print('%21s differs: %d only from python %s, '
+                      '%d only from binary %s'
+                      % (key, len(py_only), py_only[:3],
+                         len(bin_only), bin_only[:3]))
+
+    if not binary:
+        return
+
+    threshold = recommend(rows)
+    print('')
+    if threshold is None:
+        print('The python engine was faster on every corpus. Either leave the '
+              'binary uninstalled or set')
+        print('    let g:neotags_binary_threshold = %d' % (rows[-1][0] + 1))
+    else:
+        print('Recommended setting:')
+        print('    let g:neotags_binary_threshold = %d' % threshold)
+
+
+if __name__ == '__main__':
+    main()